@@ -0,0 +1,268 @@
+import asyncio
+import argparse
+import json
+import os
+import resource
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from latency import percentiles
+
+# Load generator for server.py: drives many simulated clients over localhost
+# with the text REGISTER/BRIDGE wire format. Requests carry no RequestID, as
+# sent by clients that open a connection per request, so replies come back
+# in order and a waiting BRIDGE doesn't subscribe to PEERJOINED events.
+
+MESSAGE_DELIMITER = b"\r\n\r\n"
+SCENARIOS = ["churn", "pipeline", "registry"]
+
+def register_request(client_id, client_port):
+    """Build a REGISTER request without a RequestID."""
+    return (
+        f"REGISTER\r\n"
+        f"clientID: {client_id}\r\n"
+        f"IP: 127.0.0.1\r\n"
+        f"Port: {client_port}\r\n\r\n"
+    ).encode()
+
+def bridge_request(client_id):
+    """Build a BRIDGE request without a RequestID."""
+    return (
+        f"BRIDGE\r\n"
+        f"clientID: {client_id}\r\n\r\n"
+    ).encode()
+
+def bulk_register_request(client_ids):
+    """Build a BULKREGISTER request for client_ids."""
+    records = "".join(f"Client: {client_id} 127.0.0.1:{5000 + index % 60000}\r\n"
+                      for index, client_id in enumerate(client_ids))
+    return f"BULKREGISTER\r\n{records}\r\n".encode()
+
+class Results:
+    """Latency samples and counters collected by one scenario."""
+    def __init__(self):
+        self.latencies = []
+        self.requests = 0
+        self.connections = 0
+        self.errors = 0
+
+    def summary(self, elapsed):
+        """Return the scenario's throughput and latency percentiles as a dict."""
+        return {
+            "requests": self.requests,
+            "connections": self.connections,
+            "errors": self.errors,
+            "duration_s": round(elapsed, 3),
+            "requests_per_sec": round(self.requests / elapsed, 1),
+            "connections_per_sec": round(self.connections / elapsed, 1),
+            "latency_us": percentiles(self.latencies),
+        }
+
+async def read_replies(reader, count):
+    """Wait for count framed replies, skipping PEERJOINED pushes the server sends unasked."""
+    while count:
+        frame = await reader.readuntil(MESSAGE_DELIMITER)
+        if not frame.startswith(b"PEERJOINED\r\n"):
+            count -= 1
+
+async def churn_client(index, host, port, deadline, results):
+    """Open a fresh connection for every REGISTER, like a client that connects per request."""
+    sequence = 0
+    while time.perf_counter() < deadline:
+        client_id = f"churn-{index}-{sequence}"
+        sequence += 1
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(register_request(client_id, 5000 + index % 60000))
+            await read_replies(reader, 1)
+            writer.close()
+            await writer.wait_closed()
+        except (OSError, asyncio.IncompleteReadError):
+            results.errors += 1
+            continue
+        results.latencies.append((time.perf_counter() - start) * 1e6)
+        results.requests += 1
+        results.connections += 1
+
+async def pipeline_client(index, host, port, deadline, depth, results):
+    """Keep one connection open and send depth requests per round trip."""
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        results.errors += 1
+        return
+    results.connections += 1
+    client_id = f"pipe-{index}"
+    batch = register_request(client_id, 5000 + index % 60000) + bridge_request(client_id) * (depth - 1)
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            writer.write(batch)
+            await read_replies(reader, depth)
+            # Every request in the batch waited for the whole round trip
+            latency = (time.perf_counter() - start) * 1e6
+            results.latencies.extend([latency] * depth)
+            results.requests += depth
+    except (OSError, asyncio.IncompleteReadError):
+        results.errors += 1
+    finally:
+        writer.close()
+
+async def preload_registry(host, port, size, chunk=10000):
+    """Fill the server's registry with size clients using BULKREGISTER."""
+    reader, writer = await asyncio.open_connection(host, port, limit=1024 * 1024)
+    for first in range(0, size, chunk):
+        client_ids = [f"bulk-{n}" for n in range(first, min(size, first + chunk))]
+        writer.write(bulk_register_request(client_ids))
+        await read_replies(reader, 1)
+    writer.close()
+
+async def registry_client(index, host, port, deadline, results):
+    """REGISTER then BRIDGE one at a time on a kept-alive connection."""
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        results.errors += 1
+        return
+    results.connections += 1
+    client_id = f"reg-{index}"
+    try:
+        while time.perf_counter() < deadline:
+            for request in (register_request(client_id, 5000 + index % 60000),
+                            bridge_request(client_id)):
+                start = time.perf_counter()
+                writer.write(request)
+                await read_replies(reader, 1)
+                results.latencies.append((time.perf_counter() - start) * 1e6)
+                results.requests += 1
+    except (OSError, asyncio.IncompleteReadError):
+        results.errors += 1
+    finally:
+        writer.close()
+
+async def run_scenario(name, args, host, port):
+    """Run one scenario with args.clients concurrent clients and summarize it."""
+    results = Results()
+    if name == "registry":
+        await preload_registry(host, port, args.registry_size)
+    start = time.perf_counter()
+    deadline = start + args.duration
+    if name == "churn":
+        tasks = [churn_client(i, host, port, deadline, results) for i in range(args.clients)]
+    elif name == "pipeline":
+        tasks = [pipeline_client(i, host, port, deadline, args.depth, results)
+                 for i in range(args.clients)]
+    else:
+        tasks = [registry_client(i, host, port, deadline, results) for i in range(args.clients)]
+    await asyncio.gather(*tasks)
+    summary = results.summary(time.perf_counter() - start)
+    if name == "registry":
+        summary["registry_size"] = args.registry_size
+    if name == "pipeline":
+        summary["depth"] = args.depth
+    return summary
+
+def wait_for_server(host, port, timeout=10.0):
+    """Block until host:port accepts connections."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def start_server(port, server_args):
+    """Launch server.py on localhost and wait for it to listen."""
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    command = [sys.executable, server_path, "--port", str(port)] + shlex.split(server_args)
+    server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    if not wait_for_server("127.0.0.1", port):
+        server.kill()
+        sys.stdout.write("Error: Server did not start.\n")
+        sys.exit(1)
+    return server
+
+def compare_to_baseline(report, baseline_path, tolerance):
+    """Print regressions against a previous report; return True if any were found."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressed = False
+    for name, current in report["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        if current["requests_per_sec"] < previous["requests_per_sec"] * (1 - tolerance):
+            sys.stdout.write(f"REGRESSION: {name} requests/sec {previous['requests_per_sec']} "
+                             f"-> {current['requests_per_sec']}\n")
+            regressed = True
+        old_p99, new_p99 = previous["latency_us"]["p99"], current["latency_us"]["p99"]
+        if old_p99 and new_p99 and new_p99 > old_p99 * (1 + tolerance):
+            sys.stdout.write(f"REGRESSION: {name} p99 {old_p99}us -> {new_p99}us\n")
+            regressed = True
+    return regressed
+
+def raise_fd_limit():
+    """Allow as many open sockets as the hard limit permits."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+parser = argparse.ArgumentParser(description="Benchmark for the Chat Application server")
+parser.add_argument("--port", type=int, default=9500, help="Port to run the server on")
+parser.add_argument("--target", help="Benchmark an already running server at IP:Port instead")
+parser.add_argument("--server-args", default="", help="Extra arguments passed to server.py")
+parser.add_argument("--scenario", choices=SCENARIOS + ["all"], default="all")
+parser.add_argument("--clients", type=int, default=1000, help="Concurrent simulated clients")
+parser.add_argument("--duration", type=float, default=5.0, help="Seconds per scenario")
+parser.add_argument("--depth", type=int, default=16, help="Requests per batch in the pipeline scenario")
+parser.add_argument("--registry-size", type=int, default=100000,
+                    help="Clients preloaded in the registry scenario")
+parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON report")
+parser.add_argument("--baseline", help="Previous JSON report to check for regressions")
+parser.add_argument("--tolerance", type=float, default=0.10,
+                    help="Allowed fractional slowdown before reporting a regression")
+args = parser.parse_args()
+
+raise_fd_limit()
+scenarios = SCENARIOS if args.scenario == "all" else [args.scenario]
+report = {
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "server_args": args.server_args,
+    "clients": args.clients,
+    "scenarios": {},
+}
+
+for name in scenarios:
+    server = None
+    if args.target:
+        host, port = args.target.split(":")
+        port = int(port)
+    else:
+        # A fresh server per scenario keeps registries from leaking between them
+        host, port = "127.0.0.1", args.port
+        server = start_server(port, args.server_args)
+    try:
+        sys.stdout.write(f"Running {name} with {args.clients} clients for {args.duration}s...\n")
+        sys.stdout.flush()
+        summary = asyncio.run(run_scenario(name, args, host, port))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    report["scenarios"][name] = summary
+    latency = summary["latency_us"]
+    sys.stdout.write(f"  {summary['requests_per_sec']} req/s, {summary['connections_per_sec']} conn/s, "
+                     f"p50 {latency['p50']}us p99 {latency['p99']}us p999 {latency['p999']}us, "
+                     f"{summary['errors']} errors\n")
+
+with open(args.output, "w") as f:
+    json.dump(report, f, indent=2)
+sys.stdout.write(f"Results written to {args.output}\n")
+
+if args.baseline and compare_to_baseline(report, args.baseline, args.tolerance):
+    sys.exit(1)
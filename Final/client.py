@@ -1,17 +1,85 @@
 import socket
 import select
+import selectors
 import argparse
+import collections
+import hashlib
+import json
+import mmap
+import os
+import shutil
 import sys
 import ipaddress
 import signal
+import time
+import zlib
+from eventlog import log, LEVELS
+from latency import percentiles
+from framing import (BINARY_VERSION, BINARY_HEADER, OP_REGISTER, OP_REGACK, OP_BRIDGE,
+                     OP_BRIDGEACK, OP_HEARTBEAT, OP_HEARTBEATACK, OP_ERROR, OP_GROUP,
+                     OP_GROUPACK, OP_PEERJOINED, OP_RELAY, OP_CORRELATED, pack_frame,
+                     unpack_fields)
 
 READ = -1
 WRITE = 1
 
+MESSAGE_DELIMITER = b"\r\n\r\n"
+RECV_SIZE = 64 * 1024
+# Largest message body a peer may send; a bigger Content-Length ends the chat
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# File transfers move data in chunks of this size and report progress every 10%
+FILE_CHUNK = 4 * 1024 * 1024
+# Largest file a peer may send unless --max-file-size says otherwise
+MAX_FILE_SIZE = 4 * 1024 * 1024 * 1024
+# Group sessions: how long to try each member, and how many queued messages
+# one sendmsg() call may carry (well under the usual IOV_MAX of 1024)
+GROUP_CONNECT_TIMEOUT = 2.0
+SENDMSG_BATCH = 512
+
+# Binary framing (see framing.py): what each reply opcode means
+OPCODE_REPLIES = {OP_REGACK: "REGACK", OP_BRIDGEACK: "BRIDGEACK", OP_GROUPACK: "GROUPACK",
+                  OP_HEARTBEATACK: "HEARTBEATACK", OP_PEERJOINED: "PEERJOINED", OP_ERROR: "ERROR"}
+# Messages the server sends without being asked
+PUSHED_EVENTS = {"PEERJOINED"}
+COMMAND_OPCODES = {"REGISTER": OP_REGISTER, "BRIDGE": OP_BRIDGE, "HEARTBEAT": OP_HEARTBEAT,
+                   "GROUP": OP_GROUP}
+
+# Control connection to the server: how long to wait for a reply, and how to
+# back off between reconnect attempts
+REQUEST_TIMEOUT = 10.0
+RECONNECT_ATTEMPTS = 5
+RECONNECT_MIN_DELAY = 0.2
+RECONNECT_MAX_DELAY = 5.0
+
+# Chat benchmark (--bench): at most this many message bytes are awaiting their
+# echo, so the two sides can never both block on full socket buffers; and how
+# long to wait for the last echoes once sending stops
+BENCH_WINDOW = 128 * 1024
+BENCH_DRAIN_TIMEOUT = 5.0
+# Headless runs take these commands when no --script is given
+BENCH_SCRIPT = ["/register", "/bridge", "/chat"]
+
+# Chat compression: each side advertises it in a CAPS message when the chat
+# starts. CHAT bodies of at least --compress-threshold bytes are then deflated
+# by one zlib stream per direction that lasts the whole session, primed with a
+# dictionary of common JSON and chat text, so repeated keys and phrases cost a
+# few bits even in the first message. Peers only compress for each other if
+# their dictionaries match.
+COMPRESS_LEVEL = 6
+COMPRESSION_DICTIONARY = (
+    b'null, true, false, ": [", ": {", "}, {"'
+    b'"id": "type": "name": "value": "data": "status": "error": "result": '
+    b'"message": "text": "items": "count": "timestamp": "time": "user": "client": '
+    b'"request": "response": "payload": "version": "code": "ok": '
+    b'the and that this with from have you for are not was what'
+    b'CHAT\r\nContent-Length: FILE\r\nName: Size: QUIT\r\nGoodbye!\r\n\r\n'
+)
+COMPRESSION_ID = "deflate-" + hashlib.sha256(COMPRESSION_DICTIONARY).hexdigest()[:8]
+
 # Signal handler for graceful shutdown
 def signal_handler(signum, frame):
     """Handle interrupt signals gracefully."""
-    sys.stdout.write("Received interrupt signal. Shutting down gracefully...\n")
+    log.info("Received interrupt signal. Shutting down gracefully...\n")
     if 'client_socket' in globals() and client_socket:
         try:
             quit_to_peer(client_socket)
@@ -24,39 +92,302 @@ def signal_handler(signum, frame):
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
-def register(client_socket, client_id, client_ip, client_port):
-    """Send a REGISTER request to the server."""
-    register_request = (
-        f"REGISTER\r\n"
-        f"clientID: {client_id}\r\n"
-        f"IP: {client_ip}\r\n"
-        f"Port: {client_port}\r\n\r\n"
-    )
-    client_socket.sendall(register_request.encode())
-    response = client_socket.recv(1024).decode().strip()
-    #sys.stdout.write(f"Server response: {response}\n")
-    return response
-
-def bridge(client_socket, client_id):
-    """Send a BRIDGE request to the server."""
-    bridge_request = (
-        f"BRIDGE\r\n"
-        f"clientID: {client_id}\r\n\r\n"
-    )
-    client_socket.sendall(bridge_request.encode())
-    response = client_socket.recv(1024).decode().strip()
-    #sys.stdout.write(f"Server response: {response}\n")
-    return response
-
-def chat(client_socket, message):
-    """Send a CHAT message to the peer."""
+class ControlChannel:
+    """One long-lived connection to the server for the whole session.
+
+    Every request carries an ID that the server echoes in its reply, so several
+    requests can be in flight at once and replies are matched up by ID. If the
+    connection drops, it is reopened with exponential backoff and requests that
+    were still waiting for a reply are sent again, along with the standing
+    BRIDGE or GROUP whose server-side state ended with the old connection.
+    When the server expires
+    registrations, a HEARTBEAT goes out every half TTL to keep ours.
+    """
+    def __init__(self, address, binary=False):
+        self.address = address
+        self.binary = binary
+        self.sock = None
+        self.buffer = bytearray()
+        self.next_id = 1
+        # Requests sent but not yet answered: {request ID: (command, fields)}
+        self.pending = {}
+        # Replies received but not yet collected: {request ID: (type, values)}
+        self.replies = {}
+        # Events the server pushed without being asked, as (type, values)
+        self.events = []
+        # Requests whose replies are delivered as events instead of to wait()
+        self.background = set()
+        # (command, fields) of a BRIDGE we are waiting on or the GROUP we are in
+        self.standing = None
+        # The HEARTBEAT fields, its interval and when it is next due (None if never)
+        self.heartbeat = []
+        self.heartbeat_interval = 0.0
+        self.next_heartbeat = None
+
+    def connect(self):
+        """Open the connection, retrying with backoff, and resend unanswered requests."""
+        delay = RECONNECT_MIN_DELAY
+        for attempt in range(RECONNECT_ATTEMPTS):
+            try:
+                self.sock = socket.create_connection(self.address, timeout=REQUEST_TIMEOUT)
+                break
+            except OSError as e:
+                if attempt == RECONNECT_ATTEMPTS - 1:
+                    raise
+                log.error(f"Error connecting to server: {e}. Retrying in {delay:.1f}s\n")
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        self.buffer.clear()
+        for request_id, (command, fields) in self.pending.items():
+            self.sock.sendall(self.encode(request_id, command, fields))
+        if self.standing is not None and self.standing not in self.pending.values():
+            request_id = str(self.next_id)
+            self.next_id += 1
+            self.pending[request_id] = self.standing
+            self.background.add(request_id)
+            self.sock.sendall(self.encode(request_id, *self.standing))
+
+    def close(self):
+        """Close the connection; the next request opens a new one."""
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def encode(self, request_id, command, fields):
+        """Return the wire form of a request with its (name, value) fields."""
+        if self.binary:
+            return pack_frame(COMMAND_OPCODES[command] | OP_CORRELATED,
+                              [request_id] + [value for _, value in fields])
+        lines = "".join(f"{name}: {value}\r\n" for name, value in fields)
+        return f"{command}\r\n{lines}RequestID: {request_id}\r\n\r\n".encode()
+
+    def send(self, command, fields):
+        """Send a request without waiting for its reply and return its ID."""
+        request_id = str(self.next_id)
+        self.next_id += 1
+        self.pending[request_id] = (command, fields)
+        if self.sock is None:
+            self.connect()
+            return request_id
+        try:
+            self.sock.sendall(self.encode(request_id, command, fields))
+        except OSError:
+            self.close()
+            self.connect()
+        return request_id
+
+    def wait(self, request_id):
+        """Return the (type, values) reply to request_id, reading until it arrives."""
+        while request_id not in self.replies:
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                raise TimeoutError("no reply from server")
+            except OSError:
+                data = b""
+            if not data:
+                self.close()
+                self.connect()
+                continue
+            self.buffer += data
+            self.read_replies()
+        return self.replies.pop(request_id)
+
+    def call(self, command, fields):
+        """Send a request and wait for its reply."""
+        return self.wait(self.send(command, fields))
+
+    def read_replies(self):
+        """Move every complete reply in the buffer into self.replies."""
+        while self.buffer:
+            if self.buffer[0] == BINARY_VERSION:
+                if len(self.buffer) < BINARY_HEADER.size:
+                    return
+                _, opcode, length = BINARY_HEADER.unpack_from(self.buffer)
+                end = BINARY_HEADER.size + length
+                if len(self.buffer) < end:
+                    return
+                try:
+                    values = unpack_fields(self.buffer[BINARY_HEADER.size:end])
+                except ValueError as e:
+                    log.error(f"Error: Malformed binary frame from server: {e}\n")
+                    values = None
+                del self.buffer[:end]
+                if values is None:
+                    continue
+                if opcode & OP_CORRELATED and values:
+                    reply_type = OPCODE_REPLIES.get(opcode & ~OP_CORRELATED, "UNKNOWN")
+                    self.complete(values[0], reply_type, values[1:])
+                else:
+                    self.uncorrelated(OPCODE_REPLIES.get(opcode, "UNKNOWN"), values)
+                continue
+            end = self.buffer.find(b"\r\n\r\n")
+            if end == -1:
+                return
+            lines = self.buffer[:end].decode().split("\r\n")
+            del self.buffer[:end + 4]
+            request_id = None
+            values = []
+            for line in lines[1:]:
+                key, _, value = line.partition(":")
+                if key == "RequestID":
+                    request_id = value.strip()
+                else:
+                    values.append(value.strip())
+            if request_id is not None:
+                self.complete(request_id, lines[0].strip(), values)
+            else:
+                self.uncorrelated(lines[0].strip(), values)
+
+    def uncorrelated(self, reply_type, values):
+        """File a message that carries no request ID as a pushed event or a reply.
+
+        Servers that don't echo request IDs answer requests in order, so such
+        a reply belongs to the oldest request still waiting.
+        """
+        if reply_type in PUSHED_EVENTS or not self.pending:
+            self.events.append((reply_type, values))
+        else:
+            self.complete(next(iter(self.pending)), reply_type, values)
+
+    def keep_alive(self, client_id, ttl):
+        """Send a HEARTBEAT for client_id every ttl / 2 seconds; a ttl of 0 stops them."""
+        self.heartbeat = [("clientID", client_id)]
+        self.heartbeat_interval = ttl / 2
+        self.next_heartbeat = time.monotonic() + self.heartbeat_interval if ttl else None
+
+    def heartbeat_timeout(self):
+        """Return seconds until the next HEARTBEAT is due, or None if none is scheduled."""
+        if self.next_heartbeat is None:
+            return None
+        return max(0.0, self.next_heartbeat - time.monotonic())
+
+    def send_heartbeat(self):
+        """Send a HEARTBEAT if one is due; its HEARTBEATACK arrives as an event."""
+        if self.next_heartbeat is None or time.monotonic() < self.next_heartbeat:
+            return
+        self.next_heartbeat = time.monotonic() + self.heartbeat_interval
+        try:
+            self.background.add(self.send("HEARTBEAT", self.heartbeat))
+        except OSError as e:
+            # Still pending, so it goes out with the next connection
+            log.error(f"Error sending heartbeat: {e}\n")
+
+    def read_events(self):
+        """Receive what the server sent, collecting pushed events in self.events.
+
+        A dropped connection is reopened right away if a request or a standing
+        BRIDGE or GROUP depends on it, and otherwise by the next request.
+        Returns False if the connection is closed.
+        """
+        try:
+            data = self.sock.recv(4096)
+        except OSError:
+            data = b""
+        if not data:
+            self.close()
+            if self.standing is None and not self.pending:
+                return False
+            try:
+                self.connect()
+            except OSError as e:
+                log.error(f"Error reconnecting to server: {e}\n")
+                return False
+            return True
+        self.buffer += data
+        self.read_replies()
+        return True
+
+    def complete(self, request_id, reply_type, values):
+        """Record the reply to a pending request."""
+        if self.pending.pop(request_id, None) is None:
+            return
+        if request_id in self.background:
+            self.background.discard(request_id)
+            self.events.append((reply_type, values))
+        else:
+            self.replies[request_id] = (reply_type, values)
+
+def register(control, client_id, client_ip, client_port):
+    """Send a REGISTER request to the server and keep the registration alive."""
+    reply_type, values = control.call("REGISTER", [("clientID", client_id), ("IP", client_ip),
+                                                   ("Port", client_port)])
+    if reply_type != "REGACK":
+        raise ConnectionError("registration rejected")
+    # A server with --ttl says how long the registration lasts
+    ttl = values[4] if len(values) > 4 else ""
+    control.keep_alive(client_id, int(ttl) if ttl.isdigit() else 0)
+
+def bridge(control, client_id):
+    """Send a BRIDGE request to the server and return the peer's (clientID, IP, Port)."""
+    fields = [("clientID", client_id)]
+    reply_type, values = control.call("BRIDGE", fields)
+    if reply_type != "BRIDGEACK":
+        raise ConnectionError("bridge rejected")
+    peer = tuple((values + ["", "", ""])[:3])
+    # The server only keeps us waiting for as long as this connection lasts
+    control.standing = None if peer[0] else ("BRIDGE", fields)
+    return peer
+
+def group(control, client_id, room):
+    """Join the group session of room and return its other members as (clientID, IP, Port)."""
+    fields = [("clientID", client_id), ("Room", room)]
+    reply_type, values = control.call("GROUP", fields)
+    if reply_type != "GROUPACK":
+        raise ConnectionError("group rejected")
+    # Membership lasts as long as this connection, so a new one joins again
+    control.standing = ("GROUP", fields)
+    members = []
+    for record in values[2:]:
+        peer_id, _, address = record.rpartition(" ")
+        peer_ip, _, peer_port = address.rpartition(":")
+        members.append((peer_id, peer_ip, int(peer_port)))
+    return members
+
+def request_relay(address, client_id, peer_id, binary=False):
+    """Ask the server to relay us to peer_id and return the socket, before the RELAYACK.
+
+    Nothing may be sent on it until finish_relay() has read the RELAYACK;
+    everything after that is the peer's.
+    """
+    sock = socket.create_connection(address, timeout=REQUEST_TIMEOUT)
+    if binary:
+        sock.sendall(pack_frame(OP_RELAY, [client_id, peer_id]))
+    else:
+        sock.sendall(f"RELAY\r\nclientID: {client_id}\r\nPeer: {peer_id}\r\n\r\n".encode())
+    return sock
+
+def finish_relay(sock, binary=False, timeout=None):
+    """Read the RELAYACK on a relay socket; raise ConnectionError unless it connected."""
+    sock.settimeout(timeout)
     try:
-        chat_message = f"CHAT\r\nMESSAGE:{message}\r\n\r\n"
-        client_socket.sendall(chat_message.encode())
-    except (BrokenPipeError, ConnectionResetError):
-        sys.stdout.write("Failed to send: peer disconnected\n")
-        client_socket.close()
-        raise  # Re-raise to handle in main loop
+        if binary:
+            header = sock.recv(BINARY_HEADER.size, socket.MSG_WAITALL)
+            if len(header) < BINARY_HEADER.size:
+                raise ConnectionError("server closed the relay")
+            _, _, length = BINARY_HEADER.unpack(header)
+            values = unpack_fields(sock.recv(length, socket.MSG_WAITALL) if length else b"")
+        else:
+            # One byte at a time, so none of the peer's bytes are taken with it
+            reply = bytearray()
+            while not reply.endswith(MESSAGE_DELIMITER):
+                data = sock.recv(1)
+                if not data:
+                    raise ConnectionError("server closed the relay")
+                reply += data
+            values = [line.partition(":")[2].strip() for line in reply.decode().split("\r\n")[1:] if line]
+    except socket.timeout:
+        raise TimeoutError("no reply from relay")
+    status = values[0] if values else ""
+    if status != "connected":
+        raise ConnectionError(f"relay refused: {status}")
+    sock.settimeout(None)
+    return sock
+
+def chat_message(message):
+    """Encode a CHAT message; the body follows the headers, sized by Content-Length."""
+    body = message.encode()
+    return f"CHAT\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
 
 def quit_to_peer(client_socket):
     """Send a QUIT message to the peer."""
@@ -64,27 +395,522 @@ def quit_to_peer(client_socket):
         if client_socket:
             quit_message = "QUIT\r\nGoodbye!\r\n\r\n"
             client_socket.sendall(quit_message.encode())
-            sys.stdout.write("\nQUIT message sent: Goodbye!\n")
+            log.info("\nQUIT message sent: Goodbye!\n")
     except (BrokenPipeError, ConnectionResetError):
-        sys.stdout.write("Failed to send: peer disconnected\n")
+        log.error("Failed to send: peer disconnected\n")
         client_socket.close()
         raise
 
-def handle_peer_message(client_socket, response):
-    """Handle incoming peer messages."""
-    if not response:
-        sys.stdout.write("Peer disconnected\n")
+def read_command():
+    """Return the next command line of a headless client's script, or None for a pause.
+
+    A "/sleep SECONDS" line sets script_wake and returns None, so the event
+    loop keeps serving the network until then. When the script runs out the
+    client quits.
+    """
+    global script_wake
+    while script:
+        line = script.popleft().strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.split(" ")[0] == "/sleep":
+            script_wake = time.monotonic() + float(line[len("/sleep"):] or 1)
+            return None
+        return line
+    return "/quit"
+
+class PeerCompression:
+    """The deflate streams of one chat session and what they have done.
+
+    Once a body has gone through the deflater the peer's inflater needs it to
+    stay in step, so a compressed message is always sent compressed, even in
+    the rare case it came out larger.
+    """
+    def __init__(self, threshold):
+        self.threshold = threshold
+        # Set once the peer's CAPS says it can inflate what we send
+        self.enabled = False
+        self.deflater = zlib.compressobj(COMPRESS_LEVEL, zdict=COMPRESSION_DICTIONARY)
+        self.inflater = zlib.decompressobj(zdict=COMPRESSION_DICTIONARY)
+        self.sent = self.deflated = self.deflated_in = self.deflated_out = self.deflate_ns = 0
+        self.inflated = self.inflated_in = self.inflated_out = self.inflate_ns = 0
+
+    def accept(self, fields):
+        """Enable compression if the peer's CAPS fields offer our kind."""
+        self.enabled = fields.get("Compression") == COMPRESSION_ID
+        log.debug(f"Peer compression: {fields.get('Compression', 'none')}\n")
+
+    def chat_message(self, message):
+        """Encode a CHAT message, deflating the body if it is large enough."""
+        body = message.encode()
+        self.sent += 1
+        if not self.enabled or len(body) < self.threshold:
+            return f"CHAT\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+        start = time.thread_time_ns()
+        data = self.deflater.compress(body) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        self.deflate_ns += time.thread_time_ns() - start
+        self.deflated += 1
+        self.deflated_in += len(body)
+        self.deflated_out += len(data)
+        return f"CHAT\r\nContent-Length: {len(data)}\r\nContent-Encoding: deflate\r\n\r\n".encode() + data
+
+    def inflate(self, data):
+        """Return the body of a deflated message; raise ValueError if it exceeds MAX_MESSAGE_SIZE."""
+        start = time.thread_time_ns()
+        # Stop just past the limit instead of inflating whatever the peer packed in
+        body = self.inflater.decompress(data, MAX_MESSAGE_SIZE + 1)
+        self.inflate_ns += time.thread_time_ns() - start
+        if len(body) > MAX_MESSAGE_SIZE or self.inflater.unconsumed_tail:
+            raise ValueError("deflated message inflates past the size limit")
+        self.inflated += 1
+        self.inflated_in += len(data)
+        self.inflated_out += len(body)
+        return body
+
+    def summary(self):
+        """Describe the session's compression ratio and CPU cost in one line."""
+        def ratio(raw, wire):
+            return f"{raw / wire:.1f}x" if wire else "-"
+
+        return (f"COMPRESSION: sent {self.deflated}/{self.sent} messages deflated, "
+                f"{self.deflated_in} -> {self.deflated_out} bytes ({ratio(self.deflated_in, self.deflated_out)}, "
+                f"{self.deflate_ns / 1e6:.1f} ms CPU); received {self.inflated} deflated, "
+                f"{self.inflated_in} -> {self.inflated_out} bytes ({ratio(self.inflated_out, self.inflated_in)}, "
+                f"{self.inflate_ns / 1e6:.1f} ms CPU)\n")
+
+def bench_chat(peer_socket, rate, size, duration):
+    """Send synthetic CHAT traffic to an echoing peer and return a report dict.
+
+    Each message body starts with its sequence number and is padded to size
+    bytes; the round trip is timed when the peer sends it back. Messages go out
+    at rate per second, or as fast as the BENCH_WINDOW allows if rate is 0.
+    """
+    stream = PeerStream()
+    padding = "x" * max(0, size - 10)
+    sent_at = {}
+    latencies = []
+    sequence = received = wire_bytes = 0
+    window = max(1, BENCH_WINDOW // max(size, 1))
+    interval = 1.0 / rate if rate else 0.0
+    start = next_send = last_echo = time.perf_counter()
+    deadline = start + duration
+    while True:
+        now = time.perf_counter()
+        if now >= deadline and (not sent_at or now >= deadline + BENCH_DRAIN_TIMEOUT):
+            break
+        if now < deadline and len(sent_at) < window and now >= next_send:
+            message = chat_message(f"{sequence:010d}{padding}")
+            peer_socket.sendall(message)
+            sent_at[sequence] = time.perf_counter()
+            sequence += 1
+            next_send += interval
+            continue
+        if now >= deadline:
+            timeout = deadline + BENCH_DRAIN_TIMEOUT - now
+        elif len(sent_at) >= window:
+            timeout = deadline - now
+        else:
+            timeout = max(0.0, min(next_send, deadline) - now)
+        readable, _, _ = select.select([peer_socket], [], [], timeout)
+        if not readable:
+            continue
+        messages = stream.read(peer_socket)
+        if messages is None:
+            raise ConnectionError("peer closed the connection")
+        last_echo = time.perf_counter()
+        for command, body in messages:
+            if command != "CHAT" or not body[:10].isdigit():
+                continue
+            sent = sent_at.pop(int(body[:10]), None)
+            if sent is not None:
+                latencies.append((last_echo - sent) * 1e6)
+                received += 1
+                wire_bytes += len(chat_message(body))
+    elapsed = max(last_echo - start, 1e-9)
+    return {
+        "messages": received,
+        "message_size": size,
+        "target_rate": rate,
+        "lost": len(sent_at),
+        "duration_s": round(elapsed, 3),
+        "messages_per_sec": round(received / elapsed, 1),
+        "bytes_per_sec": round(wire_bytes / elapsed, 1),
+        "latency_us": percentiles(latencies),
+    }
+
+def echo_chat(peer_socket):
+    """Send every CHAT from a benchmarking peer straight back until it quits."""
+    stream = PeerStream()
+    while True:
+        messages = stream.read(peer_socket)
+        if messages is None:
+            return
+        echoes = bytearray()
+        for command, body in messages:
+            if command == "QUIT":
+                peer_socket.sendall(echoes)
+                return
+            if command == "CHAT":
+                echoes += chat_message(body)
+        peer_socket.sendall(echoes)
+
+class PeerStream:
+    """Incremental decoder for the messages a peer sends over the chat socket.
+
+    Data is received straight into one growable buffer with recv_into. Consumed
+    bytes are only reclaimed when more room is needed, and a message's body is
+    never rescanned, so even multi-megabyte CHAT bodies are decoded in linear time.
+    """
+    def __init__(self):
+        self.buffer = bytearray(RECV_SIZE)
+        self.start = 0      # first byte not yet decoded
+        self.end = 0        # end of the received data
+        self.scanned = 0    # where the search for the next delimiter resumes
+        self.header = None  # (command, Content-Length, deflated) of a message awaiting its body
+        # The session's PeerCompression, which inflates deflated bodies
+        self.compression = None
+
+    def reserve(self, size):
+        """Make room for at least size more bytes after self.end."""
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.scanned -= self.start
+            self.start, self.end = 0, pending
+        if len(self.buffer) - self.end < size:
+            self.buffer.extend(bytes(max(len(self.buffer), pending + size - len(self.buffer))))
+
+    def fill(self, sock):
+        """Receive once from sock into the buffer; return False at EOF."""
+        wanted = RECV_SIZE
+        if self.header is not None:
+            # Make room for the whole body so it arrives in as few reads as possible
+            wanted = max(wanted, self.header[1] - (self.end - self.start))
+        self.reserve(wanted)
+        with memoryview(self.buffer) as view:
+            count = sock.recv_into(view[self.end:])
+        self.end += count
+        return count > 0
+
+    def read(self, sock):
+        """Receive once from sock and return the complete messages, or None at EOF."""
+        if not self.fill(sock):
+            return None
+        messages = []
+        while True:
+            message = self.next_message()
+            if message is None:
+                break
+            messages.append(message)
+            if message[0] == "FILEDATA":
+                # Raw file bytes follow; the receiver takes them with take()
+                break
+        self.release()
+        return messages
+
+    def receive(self, sock):
+        """Block until the next message has arrived and return it, or None at EOF."""
+        while True:
+            message = self.next_message()
+            if message is not None:
+                return message
+            if not self.fill(sock):
+                return None
+
+    def take(self, size):
+        """Remove and return up to size raw bytes that are already buffered."""
+        data = bytes(self.buffer[self.start:min(self.end, self.start + size)])
+        self.start += len(data)
+        self.scanned = self.start
+        self.release()
+        return data
+
+    def release(self):
+        """Rewind the buffer once everything in it has been decoded."""
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+            if len(self.buffer) > RECV_SIZE:
+                # Don't hold on to the memory of a large message
+                self.buffer = bytearray(RECV_SIZE)
+
+    def next_message(self):
+        """Decode one (command, body) message from the buffer, or return None.
+
+        Raises ValueError for a message the stream can't continue past.
+        """
+        if self.header is None:
+            end = self.buffer.find(MESSAGE_DELIMITER, max(self.scanned, self.start), self.end)
+            if end == -1:
+                self.scanned = max(self.start, self.end - len(MESSAGE_DELIMITER) + 1)
+                return None
+            command, _, rest = self.buffer[self.start:end].decode(errors="replace").partition("\r\n")
+            self.start = self.scanned = end + len(MESSAGE_DELIMITER)
+            length = None
+            deflated = False
+            for line in rest.split("\r\n"):
+                key, _, value = line.partition(":")
+                if key.strip() == "Content-Length" and value.strip().isdigit():
+                    length = int(value)
+                    if length > MAX_MESSAGE_SIZE:
+                        # Refuse before reserve() allocates room for it
+                        raise ValueError(f"{length}-byte message is too large")
+                elif key.strip() == "Content-Encoding":
+                    deflated = value.strip() == "deflate"
+            if length is None:
+                # No body: older clients put the text in a MESSAGE header
+                _, found, text = rest.partition("MESSAGE:")
+                return command.strip(), text if found else rest
+            self.header = (command.strip(), length, deflated)
+        command, length, deflated = self.header
+        if self.end - self.start < length:
+            return None
+        body = self.buffer[self.start:self.start + length]
+        if deflated:
+            if self.compression is None:
+                raise ValueError("deflated message without a compression session")
+            body = self.compression.inflate(body)
+        body = body.decode(errors="replace")
+        self.start = self.scanned = self.start + length
+        self.header = None
+        return command, body
+
+def parse_fields(text):
+    """Return the "Key: value" lines of a message's headers as a dict."""
+    fields = {}
+    for line in text.split("\r\n"):
+        key, _, value = line.partition(":")
+        fields[key.strip()] = value.strip()
+    return fields
+
+def file_checksum(data):
+    """Return the SHA-256 hex digest of a buffer (e.g. an mmap)."""
+    return hashlib.sha256(data).hexdigest()
+
+def report_progress(verb, name, done, size, reported):
+    """Log progress each time another 10% of a file is done; return the new step."""
+    step = 10 * done // size if size else 10
+    if step > reported:
+        log.info(f"FILE: {verb} {name} {step * 10}% ({done}/{size} bytes)\n")
+    return step
+
+def wait_for_peer(peer_socket, peer_stream, commands):
+    """Block until the peer sends one of commands and return its fields.
+
+    Chat messages that arrive in the meantime are shown as usual, and an offer
+    of another file is turned down, since both sides would wait on each other.
+    """
+    while True:
+        message = peer_stream.receive(peer_socket)
+        if message is None or message[0] == "QUIT":
+            raise ConnectionError("peer left during file transfer")
+        command, body = message
+        if command in commands:
+            return command, parse_fields(body)
+        if command == "FILE":
+            name = parse_fields(body).get("Name", "")
+            peer_socket.sendall(f"FILEREJECT\r\nName: {name}\r\nReason: busy\r\n\r\n".encode())
+        elif command == "CAPS":
+            # The peer's capabilities can still be on their way when a transfer starts
+            if peer_stream.compression:
+                peer_stream.compression.accept(parse_fields(body))
+        else:
+            handle_peer_message(peer_socket, message, peer_stream)
+
+def send_file(peer_socket, peer_stream, path):
+    """Offer a file to the peer and stream it with sendfile; return True once it arrived intact.
+
+    The peer answers with the offset it already holds from an earlier
+    interrupted transfer, and only the rest of the file is sent.
+    """
+    name = os.path.basename(path)
+    blocking = peer_socket.getblocking()
+    peer_socket.setblocking(True)
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+                    checksum = file_checksum(mapped)
+            else:
+                checksum = file_checksum(b"")
+            peer_socket.sendall(f"FILE\r\nName: {name}\r\nSize: {size}\r\n"
+                                f"SHA256: {checksum}\r\n\r\n".encode())
+            command, fields = wait_for_peer(peer_socket, peer_stream, ("FILEACCEPT", "FILEREJECT"))
+            if command == "FILEREJECT":
+                log.error(f"Error: Peer declined {name}: {fields.get('Reason', '')}\n")
+                return False
+            offset = int(fields.get("Offset", 0))
+            if offset:
+                log.info(f"FILE: resuming {name} at {offset}/{size} bytes\n")
+            peer_socket.sendall(f"FILEDATA\r\nName: {name}\r\nOffset: {offset}\r\n"
+                                f"Size: {size - offset}\r\n\r\n".encode())
+            position = offset
+            reported = report_progress("sent", name, position, size, -1)
+            while position < size:
+                position += peer_socket.sendfile(f, offset=position,
+                                                 count=min(FILE_CHUNK, size - position))
+                reported = report_progress("sent", name, position, size, reported)
+        _, fields = wait_for_peer(peer_socket, peer_stream, ("FILEDONE",))
+        if fields.get("Status") != "ok":
+            log.error(f"Error: Peer could not verify {name}: {fields.get('Status')}\n")
+            return False
+        return True
+    finally:
+        peer_socket.setblocking(blocking)
+
+def receive_file(peer_socket, peer_stream, fields):
+    """Accept a file offer and write the data straight into an mmap of the file.
+
+    Data is kept in "<name>.<checksum>.part" until it is complete and verified,
+    so an interrupted transfer of the same file resumes from where it stopped.
+    """
+    def reject(reason):
+        log.error(f"Error: Declined {name or 'a file'} from the peer: {reason}\n")
+        peer_socket.sendall(f"FILEREJECT\r\nName: {name}\r\nReason: {reason}\r\n\r\n".encode())
+
+    name = os.path.basename(fields.get("Name", ""))
+    size = fields.get("Size", "")
+    checksum = fields.get("SHA256", "").lower()
+    if name in ("", ".", ".."):
+        name = ""
+        reject("invalid name")
+        return
+    # The checksum becomes part of a file name, so it must be a SHA-256 digest
+    if len(checksum) != 64 or any(c not in "0123456789abcdef" for c in checksum):
+        reject("invalid checksum")
+        return
+    if not size.isdigit():
+        reject("invalid size")
+        return
+    size = int(size)
+    if size > args.max_file_size:
+        reject("too large")
+        return
+    path = os.path.join(args.download_dir, name)
+    part_path = f"{path}.{checksum[:16]}.part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > size:
+        offset = 0
+    if size - offset > shutil.disk_usage(args.download_dir).free:
+        reject("not enough space")
+        return
+
+    blocking = peer_socket.getblocking()
+    peer_socket.setblocking(True)
+    try:
+        peer_socket.sendall(f"FILEACCEPT\r\nName: {name}\r\nOffset: {offset}\r\n\r\n".encode())
+        wait_for_peer(peer_socket, peer_stream, ("FILEDATA",))
+        with open(part_path, "a+b") as f:
+            position = offset
+            try:
+                # Preallocate the whole file and receive into its mapping
+                f.truncate(size)
+                if size:
+                    with mmap.mmap(f.fileno(), size) as mapped:
+                        with memoryview(mapped) as view:
+                            buffered = peer_stream.take(size - position)
+                            view[position:position + len(buffered)] = buffered
+                            position += len(buffered)
+                            reported = report_progress("received", name, position, size, -1)
+                            while position < size:
+                                count = peer_socket.recv_into(view[position:],
+                                                              min(FILE_CHUNK, size - position))
+                                if not count:
+                                    raise ConnectionError("peer closed the connection")
+                                position += count
+                                reported = report_progress("received", name, position, size, reported)
+                        valid = file_checksum(mapped) == checksum
+                else:
+                    valid = file_checksum(b"") == checksum
+            finally:
+                if position < size:
+                    # Keep only what arrived, for the next attempt to resume from
+                    f.truncate(position)
+        if valid:
+            os.replace(part_path, path)
+            log.info(f"FILE: saved {name} ({size} bytes) to {path}\n")
+            status = "ok"
+        else:
+            os.remove(part_path)
+            log.error(f"Error: Checksum mismatch for {name}\n")
+            status = "checksum mismatch"
+        peer_socket.sendall(f"FILEDONE\r\nName: {name}\r\nStatus: {status}\r\n\r\n".encode())
+    finally:
+        peer_socket.setblocking(blocking)
+
+def send_file_command(peer_socket, peer_stream, chat_input):
+    """Run a "/send <path>" command.
+
+    Returns None if nothing was offered, "Quit" if the peer connection failed,
+    and "Chat" otherwise.
+    """
+    path = chat_input[len("/send"):].strip()
+    if not os.path.isfile(path):
+        log.error(f"Error: No such file: {path}\n")
+        return None
+    try:
+        send_file(peer_socket, peer_stream, path)
+    except (OSError, ValueError) as e:
+        log.error(f"Error sending file: {e}\n")
+        return "Quit"
+    return "Chat"
+
+class GroupPeer:
+    """One connection of a group session, with its decoder and send queue."""
+    __slots__ = ("sock", "peer_id", "stream", "outbound")
+
+    def __init__(self, sock, peer_id=""):
+        sock.setblocking(False)
+        self.sock = sock
+        self.peer_id = peer_id
+        self.stream = PeerStream()
+        # Unsent parts of encoded messages; the buffers are shared by every peer
+        self.outbound = collections.deque()
+
+    def flush(self):
+        """Send as much of the queue as the socket takes, gathered into one sendmsg() call."""
+        while self.outbound:
+            batch = [self.outbound[i] for i in range(min(len(self.outbound), SENDMSG_BATCH))]
+            try:
+                sent = self.sock.sendmsg(batch)
+            except BlockingIOError:
+                return
+            while sent:
+                head = self.outbound[0]
+                if len(head) > sent:
+                    self.outbound[0] = head[sent:]
+                    break
+                sent -= len(head)
+                self.outbound.popleft()
+            if self.outbound:
+                # The socket buffer is full; wait for EVENT_WRITE
+                return
+
+def handle_peer_message(client_socket, message, peer_stream=None):
+    """Handle an incoming peer (command, body) message; None means the peer hung up."""
+    if message is None:
+        log.info("Peer disconnected\n")
         return "Quit"
-    elif response.startswith("CHAT"):
-        message = response.split("\r\n")[1].split(":")[1].strip()
-        sys.stdout.write(f"{message}\n")
+    command, body = message
+    if command == "CHAT":
+        # Chat text is shown whatever --log-level says
+        log.output(f"{body}\n")
         return "Chat"
-    elif response.startswith("QUIT"):
-        sys.stdout.write("Peer quit\n")
+    elif command == "FILE" and peer_stream is not None:
+        try:
+            receive_file(client_socket, peer_stream, parse_fields(body))
+        except (OSError, ValueError) as e:
+            log.error(f"Error receiving file: {e}\n")
+            return "Quit"
+        return "Chat"
+    elif command == "QUIT":
+        log.info("Peer quit\n")
         client_socket.close()
         return "Quit"
     else:
-        sys.stdout.write(f"Error: Invalid response from peer: {response}\n")
+        log.error(f"Error: Invalid response from peer: {command}\n")
         return "Chat"
 
 # Parse command line arguments
@@ -92,21 +918,55 @@ parser = argparse.ArgumentParser(description="TCP Client for Chat Application")
 parser.add_argument("--id", required=True, help="Client ID")
 parser.add_argument("--port", type=int, required=True, help="Client Port")
 parser.add_argument("--server", required=True, help="Server IP and Port (e.g., 127.0.0.1:5000)")
+parser.add_argument("--binary", action="store_true", help="Use the binary protocol with the server")
+parser.add_argument("--duplex", action="store_true",
+                    help="Let both peers send at any time instead of taking turns")
+parser.add_argument("--relay", action="store_true",
+                    help="Chat through the server (started with --relay) instead of connecting directly")
+parser.add_argument("--script", help="Run the commands in this file instead of reading stdin")
+parser.add_argument("--bench", action="store_true",
+                    help="Headless chat benchmark: the client that starts the chat sends, its peer echoes")
+parser.add_argument("--bench-rate", type=float, default=0,
+                    help="Messages per second to send (0 = as fast as possible)")
+parser.add_argument("--bench-size", type=int, default=64, help="Bytes per benchmark message")
+parser.add_argument("--bench-duration", type=float, default=5.0, help="Seconds to send for")
+parser.add_argument("--bench-output", help="Where to write the benchmark report as JSON")
+parser.add_argument("--compression", choices=["deflate", "none"], default="deflate",
+                    help="Offer to compress chat messages with the peer")
+parser.add_argument("--compress-threshold", type=int, default=256,
+                    help="Smallest CHAT body, in bytes, worth compressing")
+parser.add_argument("--download-dir", default=".", help="Where files sent by the peer are saved")
+parser.add_argument("--max-file-size", type=int, default=MAX_FILE_SIZE,
+                    help="Largest file, in bytes, to accept from the peer")
+parser.add_argument("--log-level", choices=list(LEVELS), default="info", help="Lowest level of event to log")
 args = parser.parse_args()
+log.level = LEVELS[args.log_level]
+
+# Headless runs take their commands from a script instead of stdin
+script = None
+# Monotonic time a scripted /sleep lasts until
+script_wake = 0.0
+if args.script:
+    with open(args.script) as f:
+        script = collections.deque(f.read().splitlines())
+elif args.bench:
+    script = collections.deque(BENCH_SCRIPT)
 
 # Initialize client variables
 client_port = args.port if 1024 < args.port < 65536 else 5001
 if client_port != args.port:
-    sys.stdout.write("Error: Invalid client port. Using default port 5001.\n")
+    log.error("Error: Invalid client port. Using default port 5001.\n")
 
 client_state = "Zero"
 client_registered = False
 client_socket = None
+control = None
 client_id = args.id
 peer_id = peer_ip = None
 peer_port = None
 server_ip, server_port = args.server.split(":")
 read_write = 0
+relay_socket = None
 
 # Validate addresses
 try:
@@ -114,187 +974,490 @@ try:
     ipaddress.ip_address(server_ip)
     server_port = int(server_port)
 except ValueError:
-    sys.stdout.write("Error: Invalid client or server address format. Use --port=<Port> --server='<IP>:<Port>'.\n")
+    log.error("Error: Invalid client or server address format. Use --port=<Port> --server='<IP>:<Port>'.\n")
     sys.exit(1)
 
-while True:
-    # Get user input except during special states
-    if client_state not in ["Quit", "Wait", "Chat"]:
-        user_input = sys.stdin.readline().strip()
+control = ControlChannel((server_ip, server_port), args.binary)
+
+# One selector watches stdin, the control connection, the listener and every
+# peer socket in every state. Each registration carries the callback that
+# handles its events, and changing state only changes what is registered.
+selector = selectors.DefaultSelector()
+stdin_fd = sys.stdin.fileno()
+stdin_line = b""
+control_watched = None
+
+# The listener is opened the first time a peer may connect (Wait, Group) and
+# kept for later ones; it is only watched in those states, and the rest of the
+# time connections wait in its backlog
+listener = None
+listening = False
+
+# The chat peer: its decoder, what is queued for it and the compression session
+peer_stream = None
+peer_outbound = bytearray()
+compression = None
+# Members of the group session
+group_peers = []
+
+def listen_for_peers(enabled):
+    """Start or stop watching the listener; a listener that can't be opened ends the session."""
+    global listener, listening, client_state
+    if enabled == listening:
+        return
+    if enabled:
+        if listener is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind(("127.0.0.1", client_port))
+                sock.listen(socket.SOMAXCONN)
+            except OSError as e:
+                sock.close()
+                log.error(f"Error in {client_state.lower()} state: {e}\n")
+                client_state = "Quit"
+                return
+            sock.setblocking(False)
+            listener = sock
+        selector.register(listener, selectors.EVENT_READ, on_listener)
     else:
-        user_input = None
+        selector.unregister(listener)
+    listening = enabled
 
-    # Handle common commands
+def watch_control():
+    """Keep the selector on the control connection, which is replaced when it reconnects."""
+    global control_watched
+    if control.sock is control_watched:
+        return
+    if control_watched is not None:
+        selector.unregister(control_watched)
+    if control.sock is not None:
+        selector.register(control.sock, selectors.EVENT_READ, on_control)
+    control_watched = control.sock
+
+def wants_input():
+    """Return True if the current state takes a command or chat line now."""
+    if client_state == "Chat":
+        return args.duplex or read_write == WRITE
+    return client_state in ("Zero", "Group")
+
+def on_stdin(events):
+    """Run every complete line typed since the last call."""
+    global stdin_line
+    data = os.read(stdin_fd, RECV_SIZE)
+    if not data:
+        # End of input (e.g. a bot's script ran out); same as /quit
+        selector.unregister(stdin_fd)
+        handle_command("/quit")
+        return
+    *lines, stdin_line = (stdin_line + data).split(b"\n")
+    for line in lines:
+        handle_command(line.decode().strip())
+        if client_state == "Quit":
+            return
+
+def handle_command(user_input):
+    """Act on one line of input according to the current state."""
+    global client_state
     if user_input == "/id":
-        sys.stdout.write(f"{client_id}")
-        sys.stdout.flush()
-        continue
+        log.output(f"{client_id}")
     elif user_input == "/quit":
         client_state = "Quit"
-        continue
-
-    # State machine
-    if client_state == "Zero":
-        if user_input == "/register":
-            if not client_registered:
-                try:
-                    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    client_socket.connect((server_ip, server_port))
-                    #sys.stdout.write(f"Connected to server at {server_ip}:{server_port}\n")
-                    register(client_socket, client_id, "127.0.0.1", client_port)
-                    client_registered = True
-                    client_socket.close()
-                    client_socket = None
-                except Exception as e:
-                    sys.stdout.write(f"Error registering to server: {e}\n")
-            else:
-                sys.stdout.write("Error: Client already registered to server.\n")
-
-        elif user_input == "/bridge":
-            if not client_registered:
-                sys.stdout.write("Error: Client not registered.\n")
-                continue
+    elif client_state == "Zero":
+        zero_command(user_input)
+    elif client_state == "Chat":
+        chat_command(user_input)
+    elif client_state == "Group" and user_input:
+        broadcast(chat_message(user_input))
 
+def zero_command(user_input):
+    """Handle a command given before any chat has started."""
+    global client_registered, client_state, read_write, peer_id, peer_ip, peer_port
+    if user_input == "/register":
+        if not client_registered:
             try:
-                client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                client_socket.connect((server_ip, server_port))
-                #sys.stdout.write(f"Connected to server at {server_ip}:{server_port}\n")
-                
-                server_response = bridge(client_socket, client_id)
-                for line in server_response.split("\r\n"):
-                    if line.startswith("clientID:"):
-                        peer_id = line.split(":")[1].strip()
-                        if not peer_id:
-                            client_state = "Wait"
-                            read_write = READ
-                            break
-                    elif line.startswith("IP:"):
-                        peer_ip = line.split(":")[1].strip()
-                    elif line.startswith("Port:"):
-                        peer_port = int(line.split(":")[1].strip())
-                
-                client_socket.close()
-                client_socket = None
+                register(control, client_id, "127.0.0.1", client_port)
+                client_registered = True
             except Exception as e:
-                sys.stdout.write(f"Error connecting to server: {e}\n")
+                log.error(f"Error registering to server: {e}\n")
+        else:
+            log.error("Error: Client already registered to server.\n")
 
-        elif user_input == "/chat":
-            if client_registered and peer_id:
-                client_state = "Chat"
-                read_write = WRITE
+    elif user_input == "/bridge":
+        if not client_registered:
+            log.error("Error: Client not registered.\n")
+            return
+        try:
+            peer_id, bridged_ip, bridged_port = bridge(control, client_id)
+            if not peer_id:
+                # The server pushes PEERJOINED when a peer is matched, so there
+                # is nothing to poll for
+                client_state = "Wait"
+                read_write = READ
+                listen_for_peers(True)
             else:
-                sys.stdout.write("Error: Client not registered or no peer ID.\n")
-        else:
-            sys.stdout.write("Error: Invalid command.\n")
+                peer_ip = bridged_ip
+                peer_port = int(bridged_port)
+        except Exception as e:
+            log.error(f"Error connecting to server: {e}\n")
 
-    elif client_state == "Wait":
+    elif user_input.split(" ")[0] == "/group":
+        if not client_registered:
+            log.error("Error: Client not registered.\n")
+            return
         try:
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            peer_socket.bind(('127.0.0.1', client_port))
-            peer_socket.listen(1)
-            #sys.stdout.write("Waiting for peer connection...\n")
+            members = group(control, client_id, user_input[len("/group"):].strip())
+        except Exception as e:
+            log.error(f"Error connecting to server: {e}\n")
+            return
+        join_group(members)
 
-            while client_state == "Wait":
-                try:
-                    readable, _, _ = select.select([peer_socket, sys.stdin], [], [], 1.0)
-                    for sock in readable:
-                        if sock == peer_socket:
-                            client_socket, addr = peer_socket.accept()
-                            sys.stdout.write(f"Incoming chat request from {peer_id} {addr[0]}:{addr[1]}\n")
-                            client_state = "Chat"
-                            read_write = READ
-                            break
-                        elif sock == sys.stdin:
-                            user_input = sys.stdin.readline().strip()
-                            if user_input == "/quit":
-                                client_state = "Quit"
-                                break
-                except KeyboardInterrupt:
-                    client_state = "Quit"
-                    break
+    elif user_input == "/chat":
+        if client_registered and peer_id:
+            open_chat()
+        else:
+            log.error("Error: Client not registered or no peer ID.\n")
+    else:
+        log.error("Error: Invalid command.\n")
 
-        except Exception as e:
-            sys.stdout.write(f"Error in wait state: {e}\n")
+def open_chat():
+    """Connect to the bridged peer, directly or through the server's relay."""
+    try:
+        if args.relay:
+            sock = finish_relay(request_relay((server_ip, server_port), client_id, peer_id, args.binary),
+                                args.binary, REQUEST_TIMEOUT)
+        else:
+            sock = socket.create_connection((peer_ip, peer_port), timeout=REQUEST_TIMEOUT)
+    except Exception as e:
+        log.error(f"Error connecting to peer: {e}\n")
+        log.error(f"Relevant Details: {peer_ip}:{peer_port}\n")
+        return
+    start_chat(sock, WRITE)
+
+def start_chat(sock, turn):
+    """Chat with the peer on sock; turn says whether we send (WRITE) or listen (READ) first."""
+    global client_socket, client_state, read_write, peer_stream, compression
+    listen_for_peers(False)
+    client_socket = sock
+    client_state = "Chat"
+    read_write = turn
+    if args.bench:
+        run_bench()
+        return
+    sock.setblocking(False)
+    peer_stream = PeerStream()
+    selector.register(sock, selectors.EVENT_READ, on_peer)
+    if args.compression == "deflate":
+        # Both sides say what they can do; a peer that never answers gets plain text
+        compression = peer_stream.compression = PeerCompression(args.compress_threshold)
+        peer_outbound.extend(f"CAPS\r\nCompression: {COMPRESSION_ID}\r\n\r\n".encode())
+        flush_peer()
+
+def run_bench():
+    """Benchmark the chat connection: the side that opened it sends, the other echoes."""
+    global client_socket, client_state
+    client_socket.settimeout(None)
+    try:
+        if read_write == WRITE:
+            report = bench_chat(client_socket, args.bench_rate, args.bench_size, args.bench_duration)
+            latency = report["latency_us"]
+            log.info(f"BENCH: {report['messages_per_sec']} msg/s, {report['bytes_per_sec']} B/s, "
+                     f"p50 {latency['p50']}us p99 {latency['p99']}us p999 {latency['p999']}us, "
+                     f"{report['lost']} lost\n")
+            if args.bench_output:
+                with open(args.bench_output, "w") as f:
+                    json.dump(report, f, indent=2)
+        else:
+            echo_chat(client_socket)
+            client_socket.close()
+            client_socket = None
+    except Exception as e:
+        log.error(f"Error in benchmark: {e}\n")
+    client_state = "Quit"
+
+def chat_command(chat_input):
+    """Send a chat line or run /send; in half-duplex mode only when it is our turn."""
+    global client_state, read_write
+    if not args.duplex and read_write == READ:
+        log.info("Can't send message while waiting to receive\n")
+        return
+    if chat_input.startswith("/send "):
+        # The transfer runs in-line, after the messages queued before it
+        flush_peer(wait=True)
+        result = send_file_command(client_socket, peer_stream, chat_input)
+        if result == "Quit":
             client_state = "Quit"
-        finally:
-            if peer_socket:
-                peer_socket.close()
+        elif result and not args.duplex:
+            read_write *= -1
+        return
+    peer_outbound.extend(compression.chat_message(chat_input) if compression else chat_message(chat_input))
+    flush_peer()
+    if not args.duplex:
+        read_write *= -1
 
-    elif client_state == "Chat":
-        if not client_socket:
-            try:
-                client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                client_socket.connect((peer_ip, peer_port))
-                #sys.stdout.write(f"Connected to peer at {peer_ip}:{peer_port}\n")
-                read_write = WRITE
-            except Exception as e:
-                sys.stdout.write(f"Error connecting to peer: {e}\n")
-                sys.stdout.write(f"Relevant Details: {peer_ip}:{peer_port}\n")
-                continue
+def flush_peer(wait=False):
+    """Send what the peer socket takes now (everything, if wait) and watch for the rest."""
+    global client_state
+    try:
+        if wait:
+            client_socket.setblocking(True)
+            client_socket.sendall(peer_outbound)
+            peer_outbound.clear()
+            client_socket.setblocking(False)
+        elif peer_outbound:
+            del peer_outbound[:client_socket.send(peer_outbound)]
+    except BlockingIOError:
+        pass
+    except OSError as e:
+        log.error(f"Error sending to peer: {e}\n")
+        client_state = "Quit"
+        return
+    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if peer_outbound else 0)
+    selector.modify(client_socket, events, on_peer)
 
-        while client_state == "Chat":
-            try:
-                readable, _, _ = select.select([client_socket, sys.stdin], [], [], None)
-                
-                if read_write == WRITE:
-                    for sock in readable:
-                        if sock == client_socket:
-                            response = client_socket.recv(1024).decode().strip()
-                            if response.startswith("QUIT"):
-                                sys.stdout.write("Peer quit\n")
-                                client_socket.close()
-                                client_socket = None
-                                client_state = "Quit"
-                                break
-                        elif sock == sys.stdin:
-                            chat_input = sys.stdin.readline().strip()
-                            if chat_input == "/quit":
-                                client_state = "Quit"
-                                break
-                            try:
-                                chat(client_socket, chat_input)
-                                read_write *= -1
-                            except Exception as e:
-                                sys.stdout.write(f"Error sending to peer: {e}\n")
-                                client_state = "Quit"
-                                break
-
-                elif read_write == READ:
-                    for sock in readable:
-                        if sock == client_socket:
-                            response = client_socket.recv(1024).decode().strip()
-                            new_state = handle_peer_message(client_socket, response)
-                            if new_state == "Quit":
-                                client_state = "Quit"
-                                break
-                            read_write *= -1
-                        
-                        elif sock == sys.stdin:
-                            user_input = sys.stdin.readline().strip()
-                            if user_input == "/quit":
-                                client_state = "Quit"
-                                break
-                            sys.stdout.write("Can't send message while waiting to receive\n")
-                
-                else:
-                    sys.stdout.write("Error: Invalid read/write state.\n")
-                    client_state = "Quit"
-                    break
+def on_peer(events):
+    """Send queued messages and handle what the peer sent."""
+    global read_write
+    if client_socket is None or client_socket.fileno() < 0:
+        # Closed earlier in this batch of events
+        return
+    if events & selectors.EVENT_WRITE:
+        flush_peer()
+    if not events & selectors.EVENT_READ or client_state != "Chat":
+        return
+    try:
+        messages = peer_stream.read(client_socket)
+    except BlockingIOError:
+        return
+    except ValueError as e:
+        log.error(f"Error: Invalid message from peer: {e}\n")
+        end_chat()
+        return
+    if messages is None:
+        messages = [None]
+    turn_taken = False
+    for message in messages:
+        if message is not None and message[0] == "CAPS":
+            # Part of connecting, not a turn in the conversation
+            if compression:
+                compression.accept(parse_fields(message[1]))
+            continue
+        turn_taken = True
+        if handle_peer_message(client_socket, message, peer_stream) == "Quit":
+            end_chat()
+            return
+    if turn_taken and not args.duplex and read_write == READ:
+        read_write = WRITE
 
-            except KeyboardInterrupt:
-                client_state = "Quit"
-                break
-            except Exception as e:
-                sys.stdout.write(f"Error in chat state: {e}\n")
-                client_state = "Quit"
-                break
+def end_chat():
+    """Close the peer connection and end the session."""
+    global client_socket, client_state
+    selector.unregister(client_socket)
+    client_socket.close()
+    client_socket = None
+    client_state = "Quit"
+
+def on_listener(events):
+    """Take a peer's connection: the chat peer in Wait, another member in Group."""
+    try:
+        sock, addr = listener.accept()
+    except BlockingIOError:
+        return
+    if client_state == "Group":
+        add_group_peer(GroupPeer(sock))
+        return
+    # The PEERJOINED push naming this peer may be waiting in the same batch of events
+    if control.sock is not None and select.select([control.sock], [], [], 0)[0]:
+        control.read_events()
+    handle_control_events()
+    log.info(f"Incoming chat request from {peer_id} {addr[0]}:{addr[1]}\n")
+    start_chat(sock, READ)
+
+def on_control(events):
+    """Take in what the server pushed on the control connection."""
+    control.read_events()
 
-    elif client_state == "Quit":
+def handle_control_events():
+    """Act on the events the server pushed since the last call."""
+    global peer_id, relay_socket, client_registered
+    for event_type, values in control.events:
+        if event_type == "HEARTBEATACK" and values[1:2] == ["unknown"]:
+            log.error("Error: Registration expired on the server; /register again.\n")
+            client_registered = False
+            control.keep_alive(client_id, 0)
+        elif event_type in ("PEERJOINED", "BRIDGEACK") and len(values) >= 3 and values[0]:
+            # Pushed, or the answer to the BRIDGE sent again after a reconnect
+            control.standing = None
+            peer_id = values[0]
+            log.info(f"Peer {peer_id} joined from {values[1]}:{values[2]}\n")
+            if client_state == "Wait" and args.relay and relay_socket is None:
+                # The peer will come through the server, not to our listener
+                relay_socket = request_relay((server_ip, server_port), client_id, peer_id, args.binary)
+                selector.register(relay_socket, selectors.EVENT_READ, on_relay)
+    control.events.clear()
+
+def on_relay(events):
+    """Start chatting once the server has connected our relay to the peer."""
+    global relay_socket
+    selector.unregister(relay_socket)
+    sock, relay_socket = relay_socket, None
+    finish_relay(sock, args.binary, REQUEST_TIMEOUT)
+    log.info(f"Incoming chat request from {peer_id} via the server\n")
+    start_chat(sock, READ)
+
+def join_group(members):
+    """Connect to the current members of a group session; later ones connect to us."""
+    global client_state
+    hello = f"HELLO\r\nclientID: {client_id}\r\n\r\n".encode()
+    for member_id, member_ip, member_port in members:
         try:
-            if client_socket:
-                quit_to_peer(client_socket)
-                client_socket.close()
-        except Exception:
+            sock = socket.create_connection((member_ip, member_port), timeout=GROUP_CONNECT_TIMEOUT)
+            sock.sendall(hello)
+        except OSError as e:
+            log.error(f"Error connecting to {member_id} at {member_ip}:{member_port}: {e}\n")
+            continue
+        add_group_peer(GroupPeer(sock, member_id))
+    log.info(f"Joined group with {len(group_peers)} peers\n")
+    client_state = "Group"
+    listen_for_peers(True)
+
+def add_group_peer(peer):
+    """Add a member to the group session."""
+    group_peers.append(peer)
+    selector.register(peer.sock, selectors.EVENT_READ, lambda events, peer=peer: on_group_peer(peer, events))
+
+def drop_group_peer(peer, reason):
+    """Remove a member from the group session."""
+    log.info(f"{peer.peer_id or 'A peer'} {reason}\n")
+    selector.unregister(peer.sock)
+    peer.sock.close()
+    group_peers.remove(peer)
+
+def broadcast(data):
+    """Queue data to every member.
+
+    The message is encoded once and the same buffer is queued to every peer,
+    so a message to hundreds of peers costs one encode plus one sendmsg() per peer.
+    """
+    data = memoryview(data)
+    for peer in group_peers:
+        peer.outbound.append(data)
+    flush_group()
+
+def flush_group():
+    """Send what each member's socket takes and watch for room for the rest."""
+    for peer in list(group_peers):
+        if not peer.outbound:
+            continue
+        try:
+            peer.flush()
+        except OSError:
+            drop_group_peer(peer, "disconnected")
+            continue
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if peer.outbound else 0)
+        selector.modify(peer.sock, events, lambda events, peer=peer: on_group_peer(peer, events))
+
+def on_group_peer(peer, events):
+    """Handle what a group member sent, or send what is queued for it."""
+    if peer.sock.fileno() < 0:
+        # Dropped earlier in this batch of events
+        return
+    if events & selectors.EVENT_READ:
+        try:
+            messages = peer.stream.read(peer.sock)
+        except BlockingIOError:
+            return
+        except ValueError as e:
+            drop_group_peer(peer, f"sent an invalid message: {e}")
+            return
+        if messages is None:
+            drop_group_peer(peer, "left")
+            return
+        for command, body in messages:
+            if command == "HELLO":
+                peer.peer_id = parse_fields(body).get("clientID", "")
+                log.info(f"{peer.peer_id} joined\n")
+            elif command == "CHAT":
+                log.output(f"{peer.peer_id}: {body}\n")
+            elif command == "QUIT":
+                drop_group_peer(peer, "left")
+                return
+    if events & selectors.EVENT_WRITE:
+        flush_group()
+
+def leave_group():
+    """Deliver what is still queued, then say goodbye to every member."""
+    quit_message = memoryview(b"QUIT\r\nGoodbye!\r\n\r\n")
+    for peer in group_peers:
+        peer.outbound.append(quit_message)
+        try:
+            peer.sock.setblocking(True)
+            peer.sock.settimeout(GROUP_CONNECT_TIMEOUT)
+            for data in peer.outbound:
+                peer.sock.sendall(data)
+        except OSError:
             pass
-        sys.exit(0)
+        peer.sock.close()
+    group_peers.clear()
+
+def shut_down():
+    """Say goodbye to the peer or group, close everything and exit."""
+    if compression and (compression.deflated or compression.inflated):
+        log.info(compression.summary())
+    try:
+        if client_socket:
+            client_socket.setblocking(True)
+            client_socket.sendall(peer_outbound)
+            quit_to_peer(client_socket)
+            client_socket.close()
+    except Exception:
+        pass
+    leave_group()
+    if relay_socket:
+        relay_socket.close()
+    if listener:
+        listener.close()
+    control.close()
+    selector.close()
+    sys.exit(0)
+
+if script is None:
+    selector.register(stdin_fd, selectors.EVENT_READ, on_stdin)
+
+network_idle = False
+while client_state != "Quit":
+    try:
+        timeout = None
+        if script is not None and wants_input():
+            now = time.monotonic()
+            if now < script_wake:
+                timeout = script_wake - now
+            elif not script and not network_idle:
+                # Take in what has already arrived before the closing /quit
+                timeout = 0
+            else:
+                command = read_command()
+                if command is not None:
+                    handle_command(command)
+                # Only look at the network in passing before the next line
+                timeout = 0
+        heartbeat = control.heartbeat_timeout()
+        if heartbeat is not None and (timeout is None or heartbeat < timeout):
+            timeout = heartbeat
+        if client_state != "Quit":
+            ready = selector.select(timeout)
+            network_idle = not ready
+            for key, events in ready:
+                key.data(events)
+                if client_state == "Quit":
+                    break
+    except KeyboardInterrupt:
+        client_state = "Quit"
+    except Exception as e:
+        log.error(f"Error in {client_state.lower()} state: {e}\n")
+        client_state = "Quit"
+    control.send_heartbeat()
+    watch_control()
+    handle_control_events()
+
+shut_down()
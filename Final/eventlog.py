@@ -0,0 +1,104 @@
+import atexit
+import collections
+import os
+import sys
+import threading
+
+# Buffered, non-blocking event logging shared by server.py and client.py.
+# Lines go into a bounded in-memory ring and a background thread writes them
+# out, so a slow stdout (e.g. a pipe to a log shipper) never stalls the event
+# loop. When the ring is full, new lines are dropped and counted instead.
+# What the user asked to see (command replies, chat text) goes through
+# output(), which is neither filtered by level nor dropped.
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+class EventLog:
+    """Bounded log buffer drained by a background flusher thread."""
+    def __init__(self, stream=None, capacity=65536, level=INFO):
+        self.stream = stream or sys.stdout
+        self.capacity = capacity
+        self.level = level
+        self.written = 0
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._reset()
+        atexit.register(self.flush)
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Start with an empty ring and no flusher (also run in forked children)."""
+        self._ring = collections.deque()
+        self._wakeup = threading.Event()
+        # Held while taking lines off the ring and writing them, so the
+        # flusher and an explicit flush() can't reorder output. Reentrant so a
+        # signal handler that exits mid-write can still flush.
+        self._write_lock = threading.RLock()
+        self._thread = None
+
+    def write(self, text, level=INFO):
+        """Queue text for output; never blocks on the stream."""
+        if level < self.level:
+            return
+        if len(self._ring) >= self.capacity:
+            self.dropped += 1
+            return
+        self._queue(text)
+
+    def output(self, text):
+        """Queue text the user asked for; it is written whatever the level or backlog."""
+        self._queue(text)
+
+    def _queue(self, text):
+        """Add text to the ring and make sure the flusher will write it."""
+        self._ring.append(text)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="eventlog", daemon=True)
+            self._thread.start()
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def debug(self, text):
+        self.write(text, DEBUG)
+
+    def info(self, text):
+        self.write(text, INFO)
+
+    def warning(self, text):
+        self.write(text, WARNING)
+
+    def error(self, text):
+        self.write(text, ERROR)
+
+    def _drain(self):
+        """Write everything currently in the ring as one chunk."""
+        with self._write_lock:
+            lines = []
+            while self._ring:
+                lines.append(self._ring.popleft())
+            if self.dropped != self._reported_dropped:
+                lines.append(f"Warning: {self.dropped - self._reported_dropped} log lines dropped\n")
+                self._reported_dropped = self.dropped
+            if not lines:
+                return
+            try:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+            except (OSError, ValueError):
+                # stdout went away; nothing left to report to
+                pass
+            self.written += len(lines)
+
+    def _run(self):
+        """Flusher thread: sleep until lines arrive, then write them in batches."""
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self._drain()
+
+    def flush(self):
+        """Synchronously write out everything queued so far."""
+        self._drain()
+
+log = EventLog()
@@ -0,0 +1,43 @@
+import struct
+
+# Binary framing shared by server.py and client.py. A frame starts with a
+# version byte that can never begin a text message, then an opcode and the
+# body length. The body is a sequence of fields, each a 2-byte length
+# followed by UTF-8 bytes.
+
+BINARY_VERSION = 0x81
+BINARY_HEADER = struct.Struct("!BBI")
+FIELD_LENGTH = struct.Struct("!H")
+OP_REGISTER, OP_REGACK, OP_BRIDGE, OP_BRIDGEACK = 1, 2, 3, 4
+OP_HEARTBEAT, OP_HEARTBEATACK, OP_BULKREGISTER, OP_BULKREGACK = 5, 6, 7, 8
+OP_ERROR = 9
+OP_GROUP, OP_GROUPACK = 10, 11
+OP_PEERJOINED = 12
+OP_RELAY, OP_RELAYACK = 13, 14
+# Set on the opcode of a request whose first field is a request ID, and on its reply
+OP_CORRELATED = 0x80
+
+def unpack_fields(body):
+    """Return the length-prefixed fields in body (bytes or a memoryview) as strings.
+
+    Raises ValueError if a field or its length runs past the end of body.
+    """
+    fields = []
+    offset = 0
+    end = len(body)
+    while offset < end:
+        if offset + FIELD_LENGTH.size > end:
+            raise ValueError("field length overruns frame")
+        (length,) = FIELD_LENGTH.unpack_from(body, offset)
+        offset += FIELD_LENGTH.size
+        if offset + length > end:
+            raise ValueError("field overruns frame")
+        fields.append(str(body[offset:offset + length], "utf-8"))
+        offset += length
+    return fields
+
+def pack_frame(opcode, values):
+    """Return a binary frame carrying values as length-prefixed fields."""
+    body = b"".join(FIELD_LENGTH.pack(len(data)) + data
+                    for data in (str(value).encode() for value in values))
+    return BINARY_HEADER.pack(BINARY_VERSION, opcode, len(body)) + body
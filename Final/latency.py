@@ -0,0 +1,14 @@
+# Latency summaries shared by bench.py and client.py's --bench, so both
+# reports use the same percentiles.
+
+def percentiles(samples):
+    """Return the p50/p99/p999/max of samples (in microseconds), rounded to 0.1."""
+    samples = sorted(samples)
+
+    def percentile(fraction):
+        if not samples:
+            return None
+        return round(samples[min(len(samples) - 1, int(len(samples) * fraction))], 1)
+
+    return {"p50": percentile(0.5), "p99": percentile(0.99), "p999": percentile(0.999),
+            "max": round(samples[-1], 1) if samples else None}
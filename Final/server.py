@@ -1,49 +1,272 @@
 import socket
-import select
+import selectors
+import asyncio
+import multiprocessing
+import os
+import signal
 import sys
 import argparse
+import csv
+import fcntl
+import json
+import time
+from collections import OrderedDict, deque
+from eventlog import log, LEVELS
+from framing import (BINARY_VERSION, BINARY_HEADER, OP_REGISTER, OP_REGACK, OP_BRIDGE,
+                     OP_BRIDGEACK, OP_HEARTBEAT, OP_HEARTBEATACK, OP_BULKREGISTER,
+                     OP_BULKREGACK, OP_ERROR, OP_GROUP, OP_GROUPACK, OP_PEERJOINED, OP_RELAY,
+                     OP_RELAYACK, OP_CORRELATED, pack_frame, unpack_fields)
 # Store registered clients: {clientID: (IP, Port)}
 registered_clients = {}
 
+# Unpaired clients waiting for a peer, oldest first: {room: OrderedDict{clientID: None}}
+waiting_queues = {}
+# Room each waiting client is queued in: {clientID: room}
+waiting_rooms = {}
+# Current pairs, stored in both directions: {clientID: peerID}
+paired_clients = {}
+
+# Waiting clients to notify when a peer arrives: {clientID: (address, binary, worker channel)}
+bridge_subscribers = {}
+# Client each persistent connection is waiting or grouped for: {(address, worker channel): clientID}
+connection_clients = {}
+# How to reach a connected client outside its own request cycle: {address: write function}
+client_writers = {}
+# Worker channel whose requests the coordinator is serving, None outside --workers mode
+current_worker = None
+
+# Relay mode (--relay): the server forwards chat bytes between two paired clients
+relay_enabled = False
+max_relays = 0
+relays_active = 0
+# RELAY connections whose peer hasn't asked yet: {(clientID, peerID): Connection}
+relay_waiting = {}
+# Both ends of every active relay by fd: {fd: RelayEnd}
+relay_ends = {}
+
+# Group sessions, members in joining order: {room: OrderedDict{clientID: None}}
+group_members = {}
+# Group each member belongs to: {clientID: room}
+group_rooms = {}
+# Connection each member joined over, if it stays open: {clientID: (address, worker channel)}
+group_connections = {}
+
+# Open client connections in the select engine: {fd: Connection}
+connections = {}
+# Bytes queued for clients across all connections
+pending_write_bytes = 0
+
+# Partial command line read from stdin
+stdin_buffer = bytearray()
+
+# Channel to the coordinator process in --workers mode, None when this process owns the registry
+coordinator_conn = None
+# Futures for the replies the coordinator owes an asyncio worker, in request order,
+# and the semaphore that limits how many batches are outstanding
+coordinator_replies = deque()
+coordinator_window = None
+
+# Registry persistence (--state-dir): an append-only log of changes since the last snapshot
+registry_log = None
+registry_log_records = 0
+state_dir = None
+SNAPSHOT_FILE = "registry.snapshot"
+LOG_FILE = "registry.log"
+# Compact once the log holds this many records (or more records than live entries)
+COMPACT_THRESHOLD = 100000
+
+# Registration expiry (--ttl): a timer wheel of one-second slots {tick: set(clientID)}
+client_ttl = 0
+expiry_wheel = {}
+# Slot each client is currently scheduled in: {clientID: tick}
+expiry_ticks = {}
+# Last slot that has been expired
+expiry_last_tick = 0
+evicted_count = 0
+heartbeat_count = 0
+
+# Metrics: one flat row of counters per process. In --workers mode the rows live in
+# a shared array (row 0 for the coordinator, one per worker) and /stats sums them.
+METRIC_COMMANDS = ["REGISTER", "BULKREGISTER", "BRIDGE", "HEARTBEAT", "GROUP", "UNKNOWN", "CLIENT"]
+COMMAND_INDEX = {command: index for index, command in enumerate(METRIC_COMMANDS)}
+UNKNOWN_COMMAND = COMMAND_INDEX["UNKNOWN"]
+# Latency of one handle_client read-process-reply cycle
+CLIENT_COMMAND = COMMAND_INDEX["CLIENT"]
+# Log-linear latency buckets in microseconds: four per power of two
+LATENCY_BUCKETS = 160
+CONNECTIONS_OPEN, CONNECTIONS_ACCEPTED, BYTES_IN, BYTES_OUT, PENDING_WRITES = range(5)
+RELAYS_OPEN, RELAY_BYTES = 5, 6
+REQUEST_COUNTS = 7
+HISTOGRAMS = REQUEST_COUNTS + len(METRIC_COMMANDS)
+METRICS_SIZE = HISTOGRAMS + len(METRIC_COMMANDS) * LATENCY_BUCKETS
+metrics = [0] * METRICS_SIZE
+metrics_base = 0
+metrics_rows = 1
+# Optional plaintext scrape endpoint (--metrics-port)
+metrics_socket = None
+
+# Every message ends with a blank line
+MESSAGE_DELIMITER = b"\r\n\r\n"
+# Largest message a client may send before the connection is dropped (fits a large BULKREGISTER)
+MAX_MESSAGE_SIZE = 1024 * 1024
+RECV_SIZE = 64 * 1024
+# Stop reading from a client once this much of its output is unsent, and
+# resume when it drains below the low watermark
+WRITE_HIGH_WATERMARK = 256 * 1024
+WRITE_LOW_WATERMARK = 64 * 1024
+# Clients that would push the total queued output past this are dropped
+MAX_PENDING_WRITE_BYTES = 64 * 1024 * 1024
+# Batches an asyncio worker may have at the coordinator at once, so that
+# requests and replies can't fill both directions of the pipe
+COORDINATOR_WINDOW = 32
+# Relayed bytes move socket -> pipe -> socket with splice() where the OS has it
+# (no copy through user space), otherwise through one reused buffer per direction
+RELAY_SPLICE = hasattr(os, "splice")
+RELAY_PIPE_SIZE = 1024 * 1024
+RELAY_CHUNK = 256 * 1024
+# Fill/drain rounds per wakeup, so one busy relay can't starve the others
+RELAY_ROUNDS = 16
+
+# Binary framing (see framing.py): the opcode of each reply and each request
+REPLY_OPCODES = {"REGACK": OP_REGACK, "BRIDGEACK": OP_BRIDGEACK,
+                 "HEARTBEATACK": OP_HEARTBEATACK, "BULKREGACK": OP_BULKREGACK,
+                 "GROUPACK": OP_GROUPACK, "PEERJOINED": OP_PEERJOINED,
+                 "RELAYACK": OP_RELAYACK, "ERROR": OP_ERROR}
+OPCODE_COMMANDS = {OP_REGISTER: "REGISTER", OP_BRIDGE: "BRIDGE", OP_HEARTBEAT: "HEARTBEAT",
+                   OP_BULKREGISTER: "BULKREGISTER", OP_GROUP: "GROUP"}
+
+# Handlers return a reply as (type, [(field, value), ...]) so that it can be
+# sent in either the text or the binary format.
+
 # Handle REGISTER requests
-def handle_register(client_socket, client_address, message):
-    """Process REGISTER request and respond with REGACK."""
-    headers = parse_headers(message)
-    client_id = headers.get("clientID")
-    client_ip = headers.get("IP", client_address[0])
-    client_port = headers.get("Port")
+def handle_register(client_address, client_id, client_ip, client_port, ttl=None):
+    """Process REGISTER request and return the REGACK reply."""
+    client_ip = client_ip or client_address[0]
 
     if not client_id or not client_ip or not client_port:
-        sys.stdout.write("Error: Invalid REGISTER message format.\n")
-        return
+        log.error("Error: Invalid REGISTER message format.\n")
+        return None
 
-    # Store client information
-    registered_clients[client_id] = (client_ip, client_port)
-    sys.stdout.write(f"REGISTER: {client_id} from {client_ip}:{client_port} received\n")
+    store_registration(client_id, client_ip, client_port, ttl)
+    persist_registrations([(client_id, client_ip, client_port)])
+    log.info(f"REGISTER: {client_id} from {client_ip}:{client_port} received\n")
 
     # Respond with REGACK
-    regack_message = (
-        f"REGACK\r\n"
-        f"clientID: {client_id}\r\n"
-        f"IP: {client_ip}\r\n"
-        f"Port: {client_port}\r\n"
-        f"Status: registered\r\n\r\n"
-    )
-    client_socket.sendall(regack_message.encode())
+    fields = [("clientID", client_id), ("IP", client_ip), ("Port", client_port),
+              ("Status", "registered")]
+    if client_ttl:
+        # How long the registration lasts without a HEARTBEAT
+        fields.append(("TTL", ttl or client_ttl))
+    return ("REGACK", fields)
+
+# Store one client in the registry
+def store_registration(client_id, client_ip, client_port, ttl=None):
+    """Record a client's address; a new registration starts a new session."""
+    release_client(client_id)
+    leave_group(client_id)
+    bridge_subscribers.pop(client_id, None)
+    registered_clients[client_id] = (client_ip, client_port)
+    schedule_expiry(client_id, ttl)
+
+# Parse a "<clientID> <IP>:<Port>" registration record
+def parse_client_record(record):
+    """Return (clientID, IP, Port) from a bulk record, or None if malformed."""
+    client_id, _, address = record.strip().rpartition(" ")
+    client_ip, _, client_port = address.rpartition(":")
+    if not client_id.strip() or not client_ip or not client_port.isdigit():
+        return None
+    return client_id.strip(), client_ip, client_port
+
+# Handle BULKREGISTER requests
+def handle_bulk_register(client_address, records, rejected, ttl=None):
+    """Register every (clientID, IP, Port) record and return one BULKREGACK."""
+    for client_id, client_ip, client_port in records:
+        store_registration(client_id, client_ip, client_port, ttl)
+    persist_registrations(records)
+    log.info(f"BULKREGISTER: {len(records)} clients from {client_address[0]} received\n")
+
+    return ("BULKREGACK", [("Registered", len(records)), ("Rejected", rejected),
+                           ("Status", "registered")])
+
+# Read the client records of a text BULKREGISTER
+def parse_bulk_register(message):
+    """Return (records, rejected count, TTL) from a text BULKREGISTER message."""
+    records = []
+    rejected = 0
+    ttl = None
+    for line in message.split("\r\n")[1:]:
+        key, _, value = line.partition(":")
+        key = key.strip()
+        if key == "Client":
+            record = parse_client_record(value)
+            if record:
+                records.append(record)
+            else:
+                rejected += 1
+        elif key == "TTL":
+            ttl = requested_ttl(value)
+    return records, rejected, ttl
+
+# Remove a client from the waiting queues and break up its pair
+def release_client(client_id):
+    """Forget any queue entry or pairing held by client_id."""
+    room = waiting_rooms.pop(client_id, None)
+    if room is not None:
+        queue = waiting_queues[room]
+        del queue[client_id]
+        if not queue:
+            del waiting_queues[room]
+    peer_id = paired_clients.pop(client_id, None)
+    if peer_id is not None:
+        paired_clients.pop(peer_id, None)
+
+# Find a peer for a client
+def match_peer(client_id, room):
+    """Pair client_id with the longest-waiting client in room.
+
+    Returns the peer's clientID, or None after queueing client_id to wait for
+    the next BRIDGE in the room. A client that is already paired gets its
+    current peer back, and a paired client is never handed to anyone else.
+    """
+    if client_id in paired_clients:
+        return paired_clients[client_id]
+
+    if waiting_rooms.get(client_id) not in (None, room):
+        release_client(client_id)
+
+    queue = waiting_queues.get(room)
+    if queue:
+        peer_id = next(iter(queue))
+        if peer_id == client_id:
+            # Still the oldest waiter; keep waiting
+            return None
+        release_client(peer_id)
+        paired_clients[client_id] = peer_id
+        paired_clients[peer_id] = client_id
+        return peer_id
+
+    waiting_queues[room] = OrderedDict({client_id: None})
+    waiting_rooms[client_id] = room
+    return None
 
 # Handle BRIDGE requests
-def handle_bridge(client_socket, client_id):
-    """Process BRIDGE request and respond with BRIDGEACK."""
+def handle_bridge(client_id, room="", subscriber=None):
+    """Process BRIDGE request and return the BRIDGEACK reply.
+
+    If the client has to wait, subscriber (its connection's address, whether it
+    speaks the binary format, and its worker channel) is kept so that it can be
+    sent a PEERJOINED event once a peer arrives.
+    """
     if client_id not in registered_clients:
-        sys.stdout.write(f"Error: Client {client_id} not registered.\n")
-        return
+        log.error(f"Error: Client {client_id} not registered.\n")
+        return None
+
+    # Any request from a client shows it is still alive
+    schedule_expiry(client_id)
 
     # Get the peer client (if exists)
-    peer_id, peer_info = None, ("", "")
-    for registered_id, info in registered_clients.items():
-        if registered_id != client_id:
-            peer_id, peer_info = registered_id, info
-            break
+    peer_id = match_peer(client_id, room)
+    peer_info = registered_clients[peer_id] if peer_id else ("", "")
 
     # Get client's own info from registered_clients
     client_ip, client_port = registered_clients[client_id]
@@ -51,18 +274,306 @@ def handle_bridge(client_socket, client_id):
 
     # Print in requested format
     if peer_id:
-        sys.stdout.write(f"BRIDGE: {client_id} {client_ip}:{client_port} {peer_id} {peer_ip}:{peer_port}\n")
+        log.info(f"BRIDGE: {client_id} {client_ip}:{client_port} {peer_id} {peer_ip}:{peer_port}\n")
+        notify_peer_joined(peer_id, client_id)
     else:
-        sys.stdout.write(f"BRIDGE: {client_id} {client_ip}:{client_port}\n")
+        log.info(f"BRIDGE: {client_id} {client_ip}:{client_port}\n")
+        if subscriber is not None:
+            bridge_subscribers[client_id] = subscriber
+            connection_clients[(subscriber[0], subscriber[2])] = client_id
 
     # Respond with BRIDGEACK
-    bridgeack_message = (
-        f"BRIDGEACK\r\n"
-        f"clientID: {peer_id or ''}\r\n"
-        f"IP: {peer_ip or ''}\r\n"
-        f"Port: {peer_port or ''}\r\n\r\n"
-    )
-    client_socket.sendall(bridgeack_message.encode())
+    return ("BRIDGEACK", [("clientID", peer_id or ""), ("IP", peer_ip or ""),
+                          ("Port", peer_port or "")])
+
+# Tell a waiting client that its peer has arrived
+def notify_peer_joined(client_id, peer_id):
+    """Push a PEERJOINED event with peer_id's address to client_id, if it is waiting."""
+    subscriber = bridge_subscribers.pop(client_id, None)
+    if subscriber is None:
+        return
+    client_address, binary, worker = subscriber
+    peer_ip, peer_port = registered_clients[peer_id]
+    data = encode_reply(("PEERJOINED", [("clientID", peer_id), ("IP", peer_ip),
+                                        ("Port", peer_port)]), binary)
+    if worker is not None:
+        # The client's connection lives in a worker process
+        worker.send((client_address, data))
+    else:
+        push_to_client(client_address, data)
+
+# Forget what a closed connection was waiting for
+def release_connection(client_address, worker=None):
+    """Take the client behind a now closed connection out of its queue and its group.
+
+    Only connections that carry request IDs are tracked, so a client that
+    asked over a one-off connection and closed it keeps its place.
+    """
+    connection = (client_address, worker)
+    client_id = connection_clients.pop(connection, None)
+    if client_id is None:
+        return
+    subscriber = bridge_subscribers.get(client_id)
+    if subscriber is not None and (subscriber[0], subscriber[2]) == connection:
+        del bridge_subscribers[client_id]
+        release_client(client_id)
+    if group_connections.get(client_id) == connection:
+        leave_group(client_id)
+
+# Clean up after a client connection has closed
+def connection_closed(client_address):
+    """Forget a closed connection here and wherever its registry state lives."""
+    client_writers.pop(client_address, None)
+    if coordinator_conn is None:
+        release_connection(client_address)
+        return
+    try:
+        # The coordinator holds the queues; it expects no reply to this
+        coordinator_conn.send((None, client_address))
+    except OSError:
+        pass
+
+# Send a message nobody asked for
+def push_to_client(client_address, data):
+    """Write data to a client's connection, if it is still open."""
+    writer = client_writers.get(client_address)
+    if writer is not None:
+        writer(data)
+
+# Handle GROUP requests
+def handle_group(client_id, room="", connection=None):
+    """Add client_id to the group session of room and return the GROUPACK reply.
+
+    The reply lists every other member as "<clientID> <IP>:<Port>", oldest
+    first, so the new member can connect to all of them. If connection (its
+    address and worker channel) is given, the member leaves once it closes.
+    """
+    if client_id not in registered_clients:
+        log.error(f"Error: Client {client_id} not registered.\n")
+        return None
+
+    schedule_expiry(client_id)
+    if group_rooms.get(client_id) not in (None, room):
+        leave_group(client_id)
+    members = group_members.setdefault(room, OrderedDict())
+    peers = []
+    for peer_id in members:
+        if peer_id != client_id:
+            peer_ip, peer_port = registered_clients[peer_id]
+            peers.append(("Peer", f"{peer_id} {peer_ip}:{peer_port}"))
+    members[client_id] = None
+    group_rooms[client_id] = room
+    if connection is not None:
+        group_connections[client_id] = connection
+        connection_clients[connection] = client_id
+    log.info(f"GROUP: {client_id} joined {room or 'default'} with {len(peers)} peers\n")
+
+    return ("GROUPACK", [("Room", room), ("Peers", len(peers))] + peers)
+
+# Remove a client from its group session
+def leave_group(client_id):
+    """Forget client_id's group membership, if any."""
+    room = group_rooms.pop(client_id, None)
+    group_connections.pop(client_id, None)
+    if room is not None:
+        members = group_members[room]
+        del members[client_id]
+        if not members:
+            del group_members[room]
+
+# Handle HEARTBEAT requests
+def handle_heartbeat(client_id, ttl=None):
+    """Refresh a client's registration and return the HEARTBEATACK reply."""
+    global heartbeat_count
+    heartbeat_count += 1
+    if client_id in registered_clients:
+        schedule_expiry(client_id, ttl)
+        status = "alive"
+    else:
+        # Expired or never registered; the client should REGISTER again
+        status = "unknown"
+    return ("HEARTBEATACK", [("clientID", client_id), ("Status", status)])
+
+# Read the optional TTL of a request
+def requested_ttl(value):
+    """Return the TTL a client asked for, capped at the server's --ttl."""
+    try:
+        ttl = int(value or "")
+    except ValueError:
+        return None
+    return min(max(ttl, 1), client_ttl) if client_ttl else None
+
+# Put a client in the expiry slot for its TTL
+def schedule_expiry(client_id, ttl=None):
+    """(Re)arm client_id to expire ttl seconds from now (default --ttl)."""
+    if not client_ttl:
+        return
+    tick = int(time.monotonic() + (ttl or client_ttl)) + 1
+    old_tick = expiry_ticks.get(client_id)
+    if old_tick == tick:
+        return
+    if old_tick is not None:
+        slot = expiry_wheel[old_tick]
+        slot.discard(client_id)
+        if not slot:
+            del expiry_wheel[old_tick]
+    expiry_wheel.setdefault(tick, set()).add(client_id)
+    expiry_ticks[client_id] = tick
+
+# Evict every client whose slot has come up
+def expire_clients():
+    """Advance the timer wheel to now, evicting the clients in each passed slot.
+
+    Only due slots are visited, so the cost is proportional to the number of
+    evictions plus elapsed seconds, never to the size of the registry.
+    """
+    global expiry_last_tick, evicted_count
+    now_tick = int(time.monotonic())
+    if expiry_wheel:
+        for tick in range(expiry_last_tick + 1, now_tick + 1):
+            for client_id in expiry_wheel.pop(tick, ()):
+                del expiry_ticks[client_id]
+                registered_clients.pop(client_id, None)
+                release_client(client_id)
+                leave_group(client_id)
+                bridge_subscribers.pop(client_id, None)
+                persist_removal(client_id)
+                evicted_count += 1
+                log.info(f"EXPIRED: {client_id}\n")
+    expiry_last_tick = now_tick
+
+# Time the event loop may sleep before the next expiry slot
+def expiry_timeout():
+    """Return seconds until the next slot is due, or None if nothing is scheduled."""
+    if not expiry_wheel:
+        return None
+    return max(0.0, expiry_last_tick + 1 - time.monotonic())
+
+# Read registry records from a snapshot or log file
+def read_registry_records(path):
+    """Apply the records in path to registered_clients and return how many were read.
+
+    Each line is "R<TAB>clientID<TAB>IP<TAB>Port" or "D<TAB>clientID". A torn
+    last line from a crash is skipped.
+    """
+    try:
+        with open(path, "r", encoding="utf-8", newline="\n") as f:
+            lines = f.read().split("\n")
+    except FileNotFoundError:
+        return 0
+    count = 0
+    for line in lines:
+        op, _, record = line.partition("\t")
+        if op == "R":
+            fields = record.rsplit("\t", 2)
+            if len(fields) == 3:
+                registered_clients[fields[0]] = (fields[1], fields[2])
+                count += 1
+        elif op == "D" and record:
+            registered_clients.pop(record, None)
+            count += 1
+    return count
+
+# Load the persisted registry at startup
+def load_registry(directory):
+    """Restore registered_clients from directory and start a fresh log there."""
+    global state_dir
+    state_dir = directory
+    os.makedirs(state_dir, exist_ok=True)
+    start = time.perf_counter()
+    read_registry_records(os.path.join(state_dir, SNAPSHOT_FILE))
+    if read_registry_records(os.path.join(state_dir, LOG_FILE)) or not os.path.exists(
+            os.path.join(state_dir, SNAPSHOT_FILE)):
+        compact_registry()
+    else:
+        open_registry_log()
+    elapsed = time.perf_counter() - start
+    log.info(f"Loaded {len(registered_clients)} registrations from {state_dir} in {elapsed:.3f}s\n")
+
+# Import registrations from a CSV or JSONL file at startup
+def import_registrations(path):
+    """Add the clients listed in path to the registry; return (imported, rejected) counts.
+
+    CSV files hold clientID,IP,Port rows (an optional header row is skipped);
+    .jsonl files hold one {"clientID": ..., "IP": ..., "Port": ...} object per line.
+    Rows are checked like BULKREGISTER records: all three fields and a numeric port.
+    """
+    def json_row(line):
+        # A line that isn't a JSON object counts as a rejected row
+        try:
+            row = json.loads(line)
+        except ValueError:
+            return []
+        if not isinstance(row, dict):
+            return []
+        return [row.get("clientID"), row.get("IP"), row.get("Port")]
+
+    imported = rejected = 0
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.endswith(".jsonl"):
+            rows = (json_row(line) for line in f if line.strip())
+        else:
+            rows = (row for row in csv.reader(f) if row and row[0] != "clientID")
+        for row in rows:
+            row = ["" if field is None else str(field).strip() for field in row]
+            if len(row) != 3 or not all(row) or not row[2].isdigit():
+                rejected += 1
+                continue
+            store_registration(*row)
+            imported += 1
+    # One snapshot covers the whole import instead of a log record per client
+    if registry_log is not None:
+        compact_registry()
+    return imported, rejected
+
+# Write a compact snapshot of the registry and truncate the log
+def compact_registry():
+    """Replace the snapshot with the live registry and start an empty log.
+
+    The snapshot is written to a temporary file and renamed into place, so a
+    crash at any point leaves either the old or the new snapshot intact.
+    Replaying the old log over the new snapshot is harmless.
+    """
+    snapshot_path = os.path.join(state_dir, SNAPSHOT_FILE)
+    temp_path = snapshot_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8", newline="\n") as f:
+        f.write("".join(f"R\t{client_id}\t{ip}\t{port}\n"
+                        for client_id, (ip, port) in registered_clients.items()))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, snapshot_path)
+    open_registry_log()
+
+# Start an empty registration log
+def open_registry_log():
+    """(Re)open the log file, discarding records already covered by the snapshot."""
+    global registry_log, registry_log_records
+    if registry_log is not None:
+        registry_log.close()
+    registry_log = open(os.path.join(state_dir, LOG_FILE), "w", encoding="utf-8", newline="\n")
+    registry_log_records = 0
+
+# Append registry changes to the log
+def append_registry_records(records, count):
+    """Write count records to the log, compacting when the log grows too long."""
+    global registry_log_records
+    registry_log.write(records)
+    registry_log.flush()
+    registry_log_records += count
+    if registry_log_records >= max(COMPACT_THRESHOLD, len(registered_clients)):
+        compact_registry()
+
+def persist_registrations(entries):
+    """Log a list of (clientID, IP, Port) registrations when persistence is enabled."""
+    if registry_log is not None and entries:
+        append_registry_records("".join(f"R\t{client_id}\t{client_ip}\t{client_port}\n"
+                                        for client_id, client_ip, client_port in entries),
+                                len(entries))
+
+def persist_removal(client_id):
+    """Log a removed registration when persistence is enabled."""
+    if registry_log is not None:
+        append_registry_records(f"D\t{client_id}\n", 1)
 
 # Parse headers from a message
 def parse_headers(message):
@@ -75,71 +586,1058 @@ def parse_headers(message):
             headers[key.strip()] = value.strip()
     return headers
 
+# Encode a handler's reply for the wire
+def encode_reply(reply, binary, request_id=None):
+    """Render a (type, fields) reply as a binary frame or a CRLF text message.
+
+    A reply to a correlated request carries the request's ID: as the first
+    field of a binary frame, or as a RequestID line of a text message.
+    """
+    reply_type, fields = reply
+    if binary:
+        values = [value for _, value in fields]
+        if request_id is None:
+            return pack_frame(REPLY_OPCODES[reply_type], values)
+        return pack_frame(REPLY_OPCODES[reply_type] | OP_CORRELATED, [request_id] + values)
+    if request_id is not None:
+        fields = fields + [("RequestID", request_id)]
+    lines = "".join(f"{name}: {value}\r\n" for name, value in fields)
+    return f"{reply_type}\r\n{lines}\r\n".encode()
+
+# Find the optional request ID of a text message
+def text_request_id(message):
+    """Return the value of a RequestID line in message, or None."""
+    start = message.find("\r\nRequestID:")
+    if start == -1:
+        return None
+    return message[start + 12:].partition("\r")[0].strip()
+
+# Split complete messages off a receive buffer
+def extract_messages(buffer):
+    """Remove every complete message from the front of buffer and return them.
+
+    Text messages are returned as strings and binary frames as (opcode, fields)
+    tuples. Any trailing partial message is left in the buffer for the next read.
+    """
+    messages = []
+    start = 0
+    view = memoryview(buffer)
+    try:
+        while start < len(buffer):
+            if buffer[start] == BINARY_VERSION:
+                if len(buffer) - start < BINARY_HEADER.size:
+                    break
+                _, opcode, length = BINARY_HEADER.unpack_from(buffer, start)
+                body_start = start + BINARY_HEADER.size
+                if len(buffer) - body_start < length:
+                    break
+                try:
+                    messages.append((opcode, unpack_fields(view[body_start:body_start + length])))
+                except ValueError:
+                    log.error("Error: Malformed binary frame.\n")
+                start = body_start + length
+                continue
+            end = buffer.find(MESSAGE_DELIMITER, start)
+            if end == -1:
+                break
+            message = buffer[start:end].decode().strip()
+            if message:
+                messages.append(message)
+            start = end + len(MESSAGE_DELIMITER)
+    finally:
+        view.release()
+    del buffer[:start]
+    return messages
+
+# Dispatch a single client message
+def process_message(message, client_address):
+    """Run the handler for a message, record its latency and return the encoded reply."""
+    start = time.perf_counter_ns()
+    binary = isinstance(message, tuple)
+    if binary:
+        opcode, fields = message
+        request_id = None
+        if opcode & OP_CORRELATED and fields:
+            opcode &= ~OP_CORRELATED
+            request_id, fields = fields[0], fields[1:]
+        command = OPCODE_COMMANDS.get(opcode, "UNKNOWN")
+        reply = dispatch_binary(opcode, fields, client_address, request_id is not None)
+    else:
+        command = message.partition("\r")[0].strip()
+        request_id = text_request_id(message)
+        reply = dispatch_message(message, client_address, request_id is not None)
+    record_latency(COMMAND_INDEX.get(command, UNKNOWN_COMMAND), start)
+    if reply is None and request_id is not None:
+        # A client with several requests in flight needs every one answered
+        reply = ("ERROR", [("Status", "rejected")])
+    return encode_reply(reply, binary, request_id) if reply else None
+
+def dispatch_message(message, client_address, correlated=False):
+    """Run the handler for a text message and return its reply, if any.
+
+    Only a correlated request (one with a RequestID) comes over a connection
+    that stays open, so only its BRIDGE subscribes to PEERJOINED events and
+    only its GROUP membership ends with the connection.
+    """
+    command = message.partition("\r")[0].strip()
+    if command == "BULKREGISTER":
+        return handle_bulk_register(client_address, *parse_bulk_register(message))
+    headers = parse_headers(message)
+    if command == "REGISTER":
+        return handle_register(client_address, headers.get("clientID"), headers.get("IP"),
+                               headers.get("Port"), requested_ttl(headers.get("TTL")))
+    elif command == "BRIDGE":
+        client_id = headers.get("clientID")
+        if client_id:
+            return handle_bridge(client_id, headers.get("Room", ""),
+                                 (client_address, False, current_worker) if correlated else None)
+        log.error("Error: BRIDGE message missing clientID.\n")
+    elif command == "HEARTBEAT":
+        client_id = headers.get("clientID")
+        if client_id:
+            return handle_heartbeat(client_id, requested_ttl(headers.get("TTL")))
+        log.error("Error: HEARTBEAT message missing clientID.\n")
+    elif command == "GROUP":
+        client_id = headers.get("clientID")
+        if client_id:
+            return handle_group(client_id, headers.get("Room", ""),
+                                (client_address, current_worker) if correlated else None)
+        log.error("Error: GROUP message missing clientID.\n")
+    else:
+        log.error("Error: Unknown request type.\n")
+    return None
+
+def dispatch_binary(opcode, fields, client_address, correlated=False):
+    """Run the handler for a binary frame and return its reply, if any.
+
+    Field order: REGISTER clientID, IP, Port[, TTL]; BRIDGE clientID[, Room];
+    HEARTBEAT clientID[, TTL]; BULKREGISTER TTL, then clientID, IP, Port per client;
+    GROUP clientID[, Room]. RELAY clientID, Peer never gets here; handle_client
+    takes it over (and without --relay it is unknown).
+    """
+    optional = fields[1:] + ["", "", "", ""]
+    if opcode == OP_REGISTER and len(fields) >= 3:
+        return handle_register(client_address, fields[0], fields[1], fields[2],
+                               requested_ttl(optional[2]))
+    elif opcode == OP_BULKREGISTER and fields and len(fields) % 3 == 1:
+        records = [(fields[i], fields[i + 1], fields[i + 2]) for i in range(1, len(fields), 3)]
+        valid = [record for record in records if all(record) and record[2].isdigit()]
+        return handle_bulk_register(client_address, valid, len(records) - len(valid),
+                                    requested_ttl(fields[0]))
+    elif opcode == OP_BRIDGE and fields and fields[0]:
+        return handle_bridge(fields[0], optional[0],
+                             (client_address, True, current_worker) if correlated else None)
+    elif opcode == OP_HEARTBEAT and fields and fields[0]:
+        return handle_heartbeat(fields[0], requested_ttl(optional[0]))
+    elif opcode == OP_GROUP and fields and fields[0]:
+        return handle_group(fields[0], optional[0],
+                            (client_address, current_worker) if correlated else None)
+    log.error("Error: Unknown request type.\n")
+    return None
+
+# Run a batch of messages against the registry
+def process_messages(messages, client_address):
+    """Return the replies for messages, one entry (possibly None) per message.
+
+    Worker processes do not hold the registry, so they forward the whole batch
+    to the coordinator in a single round trip.
+    """
+    if coordinator_conn is not None:
+        coordinator_conn.send((messages, client_address))
+        while True:
+            replies = coordinator_conn.recv()
+            if isinstance(replies, list):
+                return replies
+            # An event for one of this worker's clients arrived first
+            push_to_client(*replies)
+    return [process_message(message, client_address) for message in messages]
+
+# Run a batch of messages from a coroutine
+async def process_messages_async(messages, client_address):
+    """Return the replies for messages without blocking the event loop.
+
+    A worker's batch goes to the coordinator and this coroutine waits for the
+    reply, which read_coordinator_async() hands over, while other clients'
+    requests keep flowing.
+    """
+    if coordinator_conn is None:
+        return process_messages(messages, client_address)
+    async with coordinator_window:
+        reply = asyncio.get_running_loop().create_future()
+        coordinator_replies.append(reply)
+        coordinator_conn.send((messages, client_address))
+        return await reply
+
+# State of one client connection in the select engine
+class Connection:
+    """A non-blocking client socket with its receive buffer and write queue."""
+    __slots__ = ("sock", "address", "inbound", "outbound", "reading", "events", "relay")
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.inbound = bytearray()
+        self.outbound = bytearray()
+        # False while the client is not consuming its replies
+        self.reading = True
+        self.events = selectors.EVENT_READ
+        # (clientID, peerID, binary) once the client has asked to be relayed
+        self.relay = None
+
 # Handle incoming client connections
-def handle_client(client_socket, client_address):
-    """Receive and process client messages."""
+def handle_client(conn):
+    """Receive client data and process every complete message in it.
+
+    The connection stays open afterwards, so a client can send any number of
+    requests (pipelined or one at a time) over it.
+    """
     try:
-        message = client_socket.recv(1024).decode().strip()
-        if not message:
+        data = conn.sock.recv(RECV_SIZE)
+        if not data:
             return False
+        start = time.perf_counter_ns()
+        metrics[metrics_base + BYTES_IN] += len(data)
+        conn.inbound += data
+        if conn.relay is not None:
+            # Waiting for the peer's RELAY; this is payload for the peer
+            return len(conn.inbound) <= MAX_MESSAGE_SIZE
 
-        if message.startswith("REGISTER"):
-            handle_register(client_socket, client_address, message)
-        elif message.startswith("BRIDGE"):
-            headers = parse_headers(message)
-            client_id = headers.get("clientID")
-            if client_id:
-                handle_bridge(client_socket, client_id)
-            else:
-                sys.stdout.write("Error: BRIDGE message missing clientID.\n")
-        else:
-            sys.stdout.write("Error: Unknown request type.\n")
+        messages = extract_messages(conn.inbound)
+        if relay_enabled:
+            for index, message in enumerate(messages):
+                conn.relay = parse_relay_request(message)
+                if conn.relay is not None:
+                    # Clients send nothing after RELAY until they get the RELAYACK
+                    messages = messages[:index]
+                    break
+        if messages:
+            replies = [reply for reply in process_messages(messages, conn.address) if reply]
+            if replies and not queue_reply(conn, b"".join(replies)):
+                return False
+            record_latency(CLIENT_COMMAND, start)
+
+        if len(conn.inbound) > MAX_MESSAGE_SIZE:
+            log.error(f"Error: Message from {conn.address} too large.\n")
+            return False
+        return True
+    except BlockingIOError:
         return True
     except Exception as e:
-        sys.stdout.write(f"Error handling client {client_address}: {e}\n")
+        log.error(f"Error handling client {conn.address}: {e}\n")
+        return False
+
+# Send a reply, queueing whatever the socket won't take right now
+def queue_reply(conn, data):
+    """Write data to the client or its queue; return False if the client must be dropped."""
+    global pending_write_bytes
+    if not conn.outbound:
+        try:
+            sent = conn.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        metrics[metrics_base + BYTES_OUT] += sent
+        if sent == len(data):
+            return True
+        data = memoryview(data)[sent:]
+    if pending_write_bytes + len(data) > MAX_PENDING_WRITE_BYTES:
+        log.error(f"Error: Write queue limit reached, dropping client {conn.address}.\n")
         return False
+    conn.outbound += data
+    pending_write_bytes += len(data)
+    metrics[metrics_base + PENDING_WRITES] = pending_write_bytes
+    if len(conn.outbound) >= WRITE_HIGH_WATERMARK:
+        conn.reading = False
+    return True
+
+# Send queued replies once the client can take them
+def flush_client(conn):
+    """Write as much of the client's queue as the socket accepts; return False on error."""
+    global pending_write_bytes
+    try:
+        sent = conn.sock.send(conn.outbound)
+    except BlockingIOError:
+        return True
+    except OSError as e:
+        log.error(f"Error handling client {conn.address}: {e}\n")
+        return False
+    del conn.outbound[:sent]
+    pending_write_bytes -= sent
+    metrics[metrics_base + BYTES_OUT] += sent
+    metrics[metrics_base + PENDING_WRITES] = pending_write_bytes
+    if len(conn.outbound) <= WRITE_LOW_WATERMARK:
+        conn.reading = True
+    return True
+
+# Record one request in the metrics
+def record_latency(command_index, start_ns):
+    """Count a request and add its latency since start_ns to the command's histogram."""
+    micros = (time.perf_counter_ns() - start_ns) // 1000
+    bits = micros.bit_length()
+    bucket = micros if bits <= 2 else (bits - 2) * 4 + ((micros >> (bits - 3)) & 3)
+    metrics[metrics_base + REQUEST_COUNTS + command_index] += 1
+    metrics[metrics_base + HISTOGRAMS + command_index * LATENCY_BUCKETS
+            + min(bucket, LATENCY_BUCKETS - 1)] += 1
+
+# Upper edge of a latency bucket
+def bucket_upper_bound(bucket):
+    """Return the largest latency (in microseconds) that falls in bucket."""
+    if bucket < 4:
+        return bucket
+    shift = bucket // 4 - 1
+    return ((4 + bucket % 4) << shift) + (1 << shift) - 1
+
+# Sum the metrics rows of every process
+def collect_metrics():
+    """Return one row of counters summed across this process and its workers."""
+    rows = [metrics[row * METRICS_SIZE:(row + 1) * METRICS_SIZE] for row in range(metrics_rows)]
+    return [sum(column) for column in zip(*rows)]
+
+# Render the metrics as plaintext
+def format_stats():
+    """Return the current metrics, one "name{labels} value" per line."""
+    totals = collect_metrics()
+    lines = [
+        f"connections_open {totals[CONNECTIONS_OPEN]}",
+        f"connections_accepted {totals[CONNECTIONS_ACCEPTED]}",
+        f"bytes_in {totals[BYTES_IN]}",
+        f"bytes_out {totals[BYTES_OUT]}",
+        f"pending_write_bytes {totals[PENDING_WRITES]}",
+        f"relays_open {totals[RELAYS_OPEN]}",
+        f"relay_bytes {totals[RELAY_BYTES]}",
+        f"registered_clients {len(registered_clients)}",
+        f"waiting_clients {len(waiting_rooms)}",
+        f"paired_clients {len(paired_clients)}",
+        f"group_members {len(group_rooms)}",
+        f"evicted_clients {evicted_count}",
+        f"log_lines_written {log.written}",
+        f"log_lines_dropped {log.dropped}",
+    ]
+    for index, command in enumerate(METRIC_COMMANDS):
+        count = totals[REQUEST_COUNTS + index]
+        lines.append(f'requests{{command="{command}"}} {count}')
+        if not count:
+            continue
+        histogram = totals[HISTOGRAMS + index * LATENCY_BUCKETS:
+                           HISTOGRAMS + (index + 1) * LATENCY_BUCKETS]
+        for quantile in ("0.5", "0.99", "0.999"):
+            target = count * float(quantile)
+            seen = 0
+            for bucket, bucket_count in enumerate(histogram):
+                seen += bucket_count
+                if seen >= target:
+                    break
+            lines.append(f'latency_us{{command="{command}",quantile="{quantile}"}} '
+                         f"{bucket_upper_bound(bucket)}")
+    return "\n".join(lines) + "\n"
+
+# Answer scrapes on the metrics endpoint
+def serve_metrics(metrics_socket, selector=None, events=None):
+    """Accept every pending metrics connection and watch it for its request.
+
+    Scrapes are answered from the event loop once their request has arrived,
+    so a slow or idle scraper never holds up client traffic. Without a
+    selector they are watched by the running asyncio loop.
+    """
+    while True:
+        try:
+            scrape_socket, _ = metrics_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        scrape_socket.setblocking(False)
+        if selector is not None:
+            selector.register(scrape_socket, selectors.EVENT_READ, answer_scrape)
+        else:
+            asyncio.get_running_loop().add_reader(scrape_socket, answer_scrape, scrape_socket)
+
+def answer_scrape(scrape_socket, selector=None, events=None):
+    """Reply to a metrics request with the plaintext stats and close the connection."""
+    if selector is not None:
+        selector.unregister(scrape_socket)
+    else:
+        asyncio.get_running_loop().remove_reader(scrape_socket)
+    try:
+        scrape_socket.recv(4096)
+        body = format_stats().encode()
+        # A few KB, well within an empty socket buffer, so this doesn't block
+        scrape_socket.send(
+            b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    except OSError:
+        pass
+    finally:
+        scrape_socket.close()
 
 # Handle server commands from stdin
 def handle_server_command(command):
     """Process server commands entered via stdin."""
+    # Replies are what the operator asked for, so they skip the level filter
+    # and go out as one entry that is never dropped
     if command == "/info":
-        for client_id, (ip, port) in registered_clients.items():
-            sys.stdout.write(f"{client_id} {ip}:{port}\n")
+        log.output("".join(f"{client_id} {ip}:{port}\n"
+                           for client_id, (ip, port) in registered_clients.items()))
+    elif command == "/stats":
+        log.output(format_stats())
+    elif command == "/ttl":
+        log.output(f"TTL: {client_ttl}s, Tracked: {len(expiry_ticks)}, "
+                   f"Evicted: {evicted_count}, Heartbeats: {heartbeat_count}\n")
+
+# Accept every pending connection on the listening socket
+def accept_clients(server_socket, selector, events=None):
+    """Drain the accept queue and register each new client with the selector."""
+    while True:
+        try:
+            client_socket, client_address = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        client_socket.setblocking(False)
+        conn = Connection(client_socket, client_address)
+        connections[client_socket.fileno()] = conn
+        client_writers[client_address] = lambda data, conn=conn: push_reply(conn, selector, data)
+        selector.register(client_socket, selectors.EVENT_READ, service_client)
+        metrics[metrics_base + CONNECTIONS_OPEN] += 1
+        metrics[metrics_base + CONNECTIONS_ACCEPTED] += 1
+
+# Read from and write to a client connection, closing it when the client is done
+def service_client(client_socket, selector, events):
+    """Handle a ready client socket and drop it on EOF or error."""
+    conn = connections[client_socket.fileno()]
+    alive = True
+    if events & selectors.EVENT_WRITE:
+        alive = flush_client(conn)
+    if alive and events & selectors.EVENT_READ and conn.reading:
+        alive = handle_client(conn)
+    if alive and conn.relay is not None and relay_waiting.get(conn.relay[:2]) is not conn:
+        if start_relay(conn, selector):
+            return
+    if alive:
+        update_interest(conn, selector)
+    else:
+        close_client(conn, selector)
+
+# Match the events a client is watched for to the state of its queues
+def update_interest(conn, selector):
+    """Re-register a client for the events its queues call for."""
+    # Watch for writability only while replies are queued, and stop reading
+    # from a client that isn't consuming them
+    wanted = ((selectors.EVENT_READ if conn.reading else 0)
+              | (selectors.EVENT_WRITE if conn.outbound else 0))
+    if wanted != conn.events:
+        selector.modify(conn.sock, wanted, service_client)
+        conn.events = wanted
+
+# Drop a client connection
+def close_client(conn, selector):
+    """Unregister and close a client, releasing its queued output."""
+    global pending_write_bytes
+    selector.unregister(conn.sock)
+    del connections[conn.sock.fileno()]
+    connection_closed(conn.address)
+    if conn.relay is not None and relay_waiting.get(conn.relay[:2]) is conn:
+        del relay_waiting[conn.relay[:2]]
+    conn.sock.close()
+    pending_write_bytes -= len(conn.outbound)
+    metrics[metrics_base + PENDING_WRITES] = pending_write_bytes
+    metrics[metrics_base + CONNECTIONS_OPEN] -= 1
+
+# Send an event to a client of the select engine
+def push_reply(conn, selector, data):
+    """Queue an unsolicited message to a client, dropping it if its queue is full."""
+    if queue_reply(conn, data):
+        update_interest(conn, selector)
+    else:
+        close_client(conn, selector)
+
+# Read server commands from stdin
+def read_stdin_commands():
+    """Run every complete command line available on stdin; return False at EOF.
+
+    stdin is read straight from its fd so that several lines arriving at once
+    are all handled instead of sitting in sys.stdin's buffer unseen by select.
+    """
+    data = os.read(sys.stdin.fileno(), 4096)
+    if not data:
+        return False
+    stdin_buffer.extend(data)
+    *lines, rest = stdin_buffer.split(b"\n")
+    stdin_buffer[:] = rest
+    for line in lines:
+        handle_server_command(line.decode().strip())
+    return True
+
+def read_stdin(stdin, selector, events=None):
+    """Process stdin commands; stop watching stdin once it reaches EOF."""
+    if not read_stdin_commands():
+        selector.unregister(stdin)
+
+# Read the clientID and peer of a RELAY request
+def parse_relay_request(message):
+    """Return (clientID, peerID, binary) if message is a RELAY request, else None."""
+    if isinstance(message, tuple):
+        opcode, fields = message
+        if opcode & OP_CORRELATED:
+            opcode, fields = opcode & ~OP_CORRELATED, fields[1:]
+        if opcode == OP_RELAY and len(fields) >= 2:
+            return fields[0], fields[1], True
+        return None
+    if message.partition("\r")[0].strip() != "RELAY":
+        return None
+    headers = parse_headers(message)
+    return headers.get("clientID", ""), headers.get("Peer", ""), False
+
+# One side of a relay session
+class RelayEnd:
+    """A relayed client socket and the bytes read from it that await its peer.
+
+    Bytes read from sock are parked in a pipe (or buffer) until the peer's
+    socket takes them; while any are parked, sock is not read, so a slow
+    receiver holds back its sender instead of growing server memory.
+    """
+    __slots__ = ("sock", "client_id", "peer", "pipe", "buffer", "start", "pending",
+                 "forwarded", "outbound", "eof", "events")
+
+    def __init__(self, sock, client_id, outbound):
+        self.sock = sock
+        self.client_id = client_id
+        self.peer = None
+        self.pending = 0
+        self.forwarded = 0
+        # Written to sock before any relayed bytes (the RELAYACK and earlier replies)
+        self.outbound = outbound
+        self.eof = False
+        self.events = 0
+        if RELAY_SPLICE:
+            self.pipe = os.pipe()
+            try:
+                fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, RELAY_PIPE_SIZE)
+            except (AttributeError, OSError):
+                # Keep the default pipe size
+                pass
+            self.buffer = None
+        else:
+            self.pipe = None
+            self.buffer = bytearray(RELAY_CHUNK)
+        self.start = 0
+
+    def fill(self):
+        """Read from sock into the pipe or buffer; return the byte count, 0 at EOF."""
+        if self.pipe is not None:
+            count = os.splice(self.sock.fileno(), self.pipe[1], RELAY_PIPE_SIZE - self.pending,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        else:
+            self.start = 0
+            count = self.sock.recv_into(self.buffer)
+        if not count:
+            self.eof = True
+        self.pending += count
+        return count
+
+    def flush(self):
+        """Write queued replies, then the peer's parked bytes, to sock; return True when done."""
+        if self.outbound:
+            del self.outbound[:self.sock.send(self.outbound)]
+            if self.outbound:
+                return False
+        source = self.peer
+        while source.pending:
+            if source.pipe is not None:
+                count = os.splice(source.pipe[0], self.sock.fileno(), source.pending,
+                                  flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                with memoryview(source.buffer) as view:
+                    count = self.sock.send(view[source.start:source.start + source.pending])
+                source.start += count
+            source.pending -= count
+            source.forwarded += count
+            metrics[metrics_base + RELAY_BYTES] += count
+        return True
+
+    def close(self):
+        """Close the socket and the pipe."""
+        self.sock.close()
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+
+# Pair a RELAY request with its peer's
+def start_relay(conn, selector):
+    """Turn conn and its peer's RELAY connection into a relay session.
+
+    Returns True once conn has been handed over to the relay. Otherwise conn
+    either waits for its peer or has been sent a RELAYACK saying why not.
+    """
+    global relays_active, pending_write_bytes
+    client_id, peer_id, binary = conn.relay
+    if paired_clients.get(client_id) != peer_id:
+        status = "not paired"
+    elif relays_active >= max_relays:
+        status = "busy"
+    else:
+        peer_conn = relay_waiting.pop((peer_id, client_id), None)
+        if peer_conn is None:
+            relay_waiting[(client_id, peer_id)] = conn
+            return False
+        status = "connected"
+    if status != "connected":
+        log.error(f"Error: Relay for {client_id} refused: {status}.\n")
+        conn.relay = None
+        queue_reply(conn, encode_reply(("RELAYACK", [("Status", status)]), binary))
+        return False
+
+    ends = []
+    for side, other in ((conn, peer_conn), (peer_conn, conn)):
+        selector.unregister(side.sock)
+        del connections[side.sock.fileno()]
+        client_writers.pop(side.address, None)
+        pending_write_bytes -= len(side.outbound)
+        # Earlier replies, then the RELAYACK, then anything the peer sent early
+        outbound = side.outbound + encode_reply(("RELAYACK", [("Status", "connected")]), side.relay[2])
+        outbound += other.inbound
+        ends.append(RelayEnd(side.sock, side.relay[0], outbound))
+    # Bytes sent while waiting for the peer count towards the session too
+    for end, side in zip(ends, (conn, peer_conn)):
+        end.forwarded = len(side.inbound)
+        metrics[metrics_base + RELAY_BYTES] += end.forwarded
+    ends[0].peer, ends[1].peer = ends[1], ends[0]
+    for end in ends:
+        relay_ends[end.sock.fileno()] = end
+        selector.register(end.sock, selectors.EVENT_READ, service_relay)
+        end.events = selectors.EVENT_READ
+    metrics[metrics_base + PENDING_WRITES] = pending_write_bytes
+    relays_active += 1
+    metrics[metrics_base + RELAYS_OPEN] += 1
+    log.info(f"RELAY: {client_id} {peer_id} started\n")
+    for end in ends:
+        update_relay(end, selector)
+    return True
+
+# Move bytes through a relay
+def service_relay(sock, selector, events):
+    """Forward what a ready relay socket has to its peer, and what is parked for it."""
+    end = relay_ends.get(sock.fileno())
+    if end is None:
+        # Closed earlier in this batch of events
+        return
+    try:
+        if events & selectors.EVENT_WRITE:
+            end.flush()
+        if events & selectors.EVENT_READ:
+            for _ in range(RELAY_ROUNDS):
+                if end.pending or end.eof or not end.fill():
+                    break
+                if not end.peer.flush():
+                    break
+    except BlockingIOError:
+        pass
+    except OSError as e:
+        log.error(f"Error relaying for {end.client_id}: {e}\n")
+        close_relay(end, selector)
+        return
+    if (end.eof and not end.pending) or (end.peer.eof and not end.peer.pending):
+        close_relay(end, selector)
+        return
+    update_relay(end, selector)
+    update_relay(end.peer, selector)
+
+# Re-register a relay socket
+def update_relay(end, selector):
+    """Read only while nothing is parked, and wait for writability while the socket owes bytes."""
+    wanted = ((selectors.EVENT_READ if not end.pending and not end.eof else 0)
+              | (selectors.EVENT_WRITE if end.outbound or end.peer.pending else 0))
+    if wanted == end.events:
+        return
+    if not wanted:
+        # Selectors can't watch for nothing; park the socket until there is work
+        selector.unregister(end.sock)
+    elif not end.events:
+        selector.register(end.sock, wanted, service_relay)
+    else:
+        selector.modify(end.sock, wanted, service_relay)
+    end.events = wanted
+
+# End a relay session
+def close_relay(end, selector):
+    """Close both sides of a relay and log how many bytes went each way."""
+    global relays_active
+    for side in (end, end.peer):
+        if side.events:
+            selector.unregister(side.sock)
+        del relay_ends[side.sock.fileno()]
+        side.close()
+        metrics[metrics_base + CONNECTIONS_OPEN] -= 1
+    relays_active -= 1
+    metrics[metrics_base + RELAYS_OPEN] -= 1
+    log.info(f"RELAY: {end.client_id} -> {end.peer.client_id} {end.forwarded} bytes, "
+             f"{end.peer.client_id} -> {end.client_id} {end.peer.forwarded} bytes\n")
+
+# Read from the coordinator between requests
+def read_coordinator(conn, selector=None, events=None):
+    """Deliver events pushed by the coordinator; stop the worker once it has gone away."""
+    try:
+        while conn.poll():
+            push_to_client(*conn.recv())
+    except (EOFError, OSError):
+        sys.exit(0)
+
+# Run the selector-based event loop
+def run_select_engine(server_socket):
+    """Serve clients from a selectors loop (epoll/kqueue where available).
+
+    The selector only wakes up when a socket or stdin is ready, and every
+    connection is looked up by fd, so idle servers stay asleep and closing a
+    connection does not scan the other clients.
+    """
+    selector = selectors.DefaultSelector()
+    selector.register(server_socket, selectors.EVENT_READ, accept_clients)
+    if coordinator_conn is not None:
+        # Server commands are read by the coordinator
+        selector.register(coordinator_conn, selectors.EVENT_READ, read_coordinator)
+    else:
+        try:
+            selector.register(sys.stdin, selectors.EVENT_READ, read_stdin)
+        except (ValueError, OSError):
+            # stdin is closed or not pollable (e.g. redirected from a file)
+            pass
+        if metrics_socket is not None:
+            selector.register(metrics_socket, selectors.EVENT_READ, serve_metrics)
+    try:
+        while True:
+            for key, events in selector.select(expiry_timeout()):
+                key.data(key.fileobj, selector, events)
+            if coordinator_conn is None:
+                # In --workers mode registrations expire in the coordinator
+                expire_clients()
+    finally:
+        for conn in connections.values():
+            conn.sock.close()
+        connections.clear()
+        for end in relay_ends.values():
+            end.close()
+        relay_ends.clear()
+        selector.close()
+
+# Serve one client connection as a coroutine
+async def handle_client_async(reader, writer):
+    """Receive and process client messages without blocking other clients."""
+    client_address = writer.get_extra_info("peername")
+    # drain() blocks this coroutine, and so its reads, above the high watermark
+    writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATERMARK, low=WRITE_LOW_WATERMARK)
+    client_writers[client_address] = writer.write
+    metrics[metrics_base + CONNECTIONS_OPEN] += 1
+    metrics[metrics_base + CONNECTIONS_ACCEPTED] += 1
+    try:
+        while True:
+            try:
+                first = await reader.readexactly(1)
+                if first[0] == BINARY_VERSION:
+                    header = first + await reader.readexactly(BINARY_HEADER.size - 1)
+                    _, opcode, length = BINARY_HEADER.unpack(header)
+                    if length > MAX_MESSAGE_SIZE:
+                        log.error(f"Error: Message from {client_address} too large.\n")
+                        break
+                    frame = header + await reader.readexactly(length)
+                elif first in (b"\r", b"\n"):
+                    # Stray line ending between messages
+                    continue
+                else:
+                    frame = first + await reader.readuntil(MESSAGE_DELIMITER)
+            except asyncio.IncompleteReadError:
+                break
+            except asyncio.LimitOverrunError:
+                log.error(f"Error: Message from {client_address} too large.\n")
+                break
+            start = time.perf_counter_ns()
+            metrics[metrics_base + BYTES_IN] += len(frame)
+            messages = extract_messages(bytearray(frame))
+            if not messages:
+                continue
+            reply = (await process_messages_async(messages, client_address))[0]
+            if reply:
+                writer.write(reply)
+                metrics[metrics_base + BYTES_OUT] += len(reply)
+                await writer.drain()
+            record_latency(CLIENT_COMMAND, start)
+    except asyncio.CancelledError:
+        # Server shutting down with the client still connected
+        pass
+    except Exception as e:
+        log.error(f"Error handling client {client_address}: {e}\n")
+    finally:
+        writer.close()
+        connection_closed(client_address)
+        metrics[metrics_base + CONNECTIONS_OPEN] -= 1
+
+# Run the asyncio event loop
+async def run_asyncio_engine(server_socket):
+    """Serve clients with asyncio.start_server, one coroutine per connection.
+
+    A slow reader only suspends its own coroutine in drain(), so it cannot
+    hold up the other connections the way a blocking sendall() does.
+    """
+    global coordinator_window
+    loop = asyncio.get_running_loop()
+
+    def read_stdin_async():
+        if not read_stdin_commands():
+            loop.remove_reader(sys.stdin)
+
+    stopped = loop.create_future()
+
+    def stop():
+        if not stopped.done():
+            stopped.set_result(None)
+
+    # sys.exit() from a plain signal handler would raise SystemExit inside
+    # whichever callback happens to be running; stop the loop in order instead
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    loop.add_signal_handler(signal.SIGTERM, stop)
+
+    if coordinator_conn is not None:
+        coordinator_window = asyncio.Semaphore(COORDINATOR_WINDOW)
+
+        # Server commands are read by the coordinator
+        def read_coordinator_async():
+            try:
+                while coordinator_conn.poll():
+                    item = coordinator_conn.recv()
+                    if not isinstance(item, list):
+                        # An event for one of this worker's clients
+                        push_to_client(*item)
+                        continue
+                    # Replies come back in the order the batches were sent
+                    reply = coordinator_replies.popleft()
+                    if not reply.done():
+                        reply.set_result(item)
+            except (EOFError, OSError):
+                loop.remove_reader(coordinator_conn)
+                stop()
+
+        loop.add_reader(coordinator_conn, read_coordinator_async)
+    else:
+        try:
+            loop.add_reader(sys.stdin, read_stdin_async)
+        except (ValueError, OSError):
+            # stdin is closed or not pollable (e.g. redirected from a file)
+            pass
+        if metrics_socket is not None:
+            loop.add_reader(metrics_socket, serve_metrics, metrics_socket)
+
+    async def expire_clients_async():
+        while True:
+            await asyncio.sleep(expiry_timeout() or 1.0)
+            expire_clients()
+
+    if client_ttl and coordinator_conn is None:
+        expiry_task = asyncio.create_task(expire_clients_async())
+
+    server = await asyncio.start_server(handle_client_async, sock=server_socket,
+                                        limit=MAX_MESSAGE_SIZE)
+    try:
+        async with server:
+            await stopped
+    finally:
+        # Hand SIGTERM back before the loop closes its wakeup pipe
+        loop.remove_signal_handler(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, previous_handler)
+
+# Create the listening socket
+def create_server_socket(reuse_port=False, port=None):
+    """Bind a non-blocking listening socket on server_ip:server_port (or port).
+
+    With reuse_port, several processes can bind the same port and the kernel
+    spreads incoming connections across them.
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((server_ip, port or server_port))
+    server_socket.listen(socket.SOMAXCONN)
+    server_socket.setblocking(False)
+    return server_socket
+
+# Run the configured engine on a listening socket
+def run_engine(server_socket):
+    """Serve clients on server_socket until interrupted."""
+    if args.engine == "asyncio":
+        asyncio.run(run_asyncio_engine(server_socket))
+    else:
+        run_select_engine(server_socket)
+
+# Body of a forked worker process
+def run_worker(conn, index):
+    """Accept clients on a SO_REUSEPORT socket and forward requests to the coordinator."""
+    global coordinator_conn, metrics_base, registry_log
+    coordinator_conn = conn
+    metrics_base = (index + 1) * METRICS_SIZE
+    # The registry, its expiry timers and its log belong to the coordinator;
+    # the copies inherited by fork() would go stale and write D records of their own
+    expiry_wheel.clear()
+    if registry_log is not None:
+        registry_log.close()
+        registry_log = None
+    try:
+        run_engine(create_server_socket(reuse_port=True))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except Exception as e:
+        log.error(f"Error in worker {os.getpid()}: {e}\n")
+    finally:
+        log.flush()
+        os._exit(0)
+
+# Fork the worker processes
+def start_workers(count):
+    """Fork count workers and return {pid: channel} for the coordinator side."""
+    global metrics, metrics_rows
+    channels = {}
+    # Row 0 holds the coordinator's metrics, row i + 1 those of worker i
+    metrics_rows = count + 1
+    metrics = multiprocessing.RawArray("q", METRICS_SIZE * metrics_rows)
+    # Don't let the children inherit (and later repeat) buffered output
+    log.flush()
+    for index in range(count):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            parent_conn.close()
+            for conn in channels.values():
+                conn.close()
+            run_worker(child_conn, index)
+        child_conn.close()
+        channels[pid] = parent_conn
+    return channels
+
+# Run the coordinator that owns the registry in --workers mode
+def run_coordinator(channels):
+    """Answer worker requests and stdin commands until every worker exits.
+
+    All registry state stays in this process, so a BRIDGE handled by any
+    worker sees clients registered through every other worker.
+    """
+    global current_worker
+    selector = selectors.DefaultSelector()
+    for conn in channels.values():
+        selector.register(conn, selectors.EVENT_READ)
+    try:
+        selector.register(sys.stdin, selectors.EVENT_READ)
+    except (ValueError, OSError):
+        # stdin is closed or not pollable (e.g. redirected from a file)
+        pass
+    if metrics_socket is not None:
+        selector.register(metrics_socket, selectors.EVENT_READ)
+    open_channels = len(channels)
+    try:
+        while open_channels:
+            for key, events in selector.select(expiry_timeout()):
+                if key.fileobj is sys.stdin:
+                    read_stdin(sys.stdin, selector)
+                    continue
+                if key.fileobj is metrics_socket:
+                    serve_metrics(metrics_socket, selector)
+                    continue
+                if key.data is not None:
+                    # A metrics scrape
+                    key.data(key.fileobj, selector, events)
+                    continue
+                conn = key.fileobj
+                try:
+                    messages, client_address = conn.recv()
+                except (EOFError, OSError):
+                    selector.unregister(conn)
+                    open_channels -= 1
+                    continue
+                current_worker = conn
+                if messages is None:
+                    # The worker closed this client's connection
+                    release_connection(client_address, conn)
+                    continue
+                conn.send([process_message(message, client_address) for message in messages])
+            expire_clients()
+    finally:
+        selector.close()
 
 parser = argparse.ArgumentParser(description="Server for Chat Application")
 parser.add_argument("--port", type=int, required=True, help="Server Port")
+parser.add_argument("--engine", choices=["select", "asyncio"], default="select",
+                    help="Event engine used to serve clients")
+parser.add_argument("--workers", type=int, default=0,
+                    help="Fork this many worker processes sharing the port via SO_REUSEPORT")
+parser.add_argument("--state-dir", help="Directory to persist registrations in across restarts")
+parser.add_argument("--import", dest="import_file",
+                    help="CSV or JSONL file of registrations to load at startup")
+parser.add_argument("--metrics-port", type=int,
+                    help="Serve plaintext metrics on this local port")
+parser.add_argument("--log-level", choices=list(LEVELS), default="info",
+                    help="Lowest level of event to log")
+parser.add_argument("--ttl", type=int, default=0,
+                    help="Evict registrations not refreshed within this many seconds (0 disables)")
+parser.add_argument("--relay", action="store_true",
+                    help="Forward chat traffic for paired clients that cannot connect directly")
+parser.add_argument("--max-relays", type=int, default=128, help="Most relay sessions at once")
 args = parser.parse_args()
+if args.relay and (args.workers or args.engine != "select"):
+    # Both ends of a relay must be sockets of the same select loop
+    parser.error("--relay needs the select engine without --workers")
+relay_enabled = args.relay
+max_relays = args.max_relays
+log.level = LEVELS[args.log_level]
+
+# Exit through the normal shutdown path on SIGTERM so queued log lines are written
+# (the asyncio engine installs its own handler on the event loop)
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
 server_port = args.port if 1024 < args.port < 65536 else 8080
 if server_port != args.port:
-    sys.stdout.write("Error: Invalid server port. Using default port 8080.\n")
+    log.error("Error: Invalid server port. Using default port 8080.\n")
 server_ip = "127.0.0.1"
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-server_socket.bind((server_ip, server_port))
-server_socket.listen(3)
 
-sys.stdout.write(f"Server listening on {server_ip}:{server_port}\n")
-sockets_list = [server_socket, sys.stdin]
+if args.state_dir:
+    load_registry(args.state_dir)
+
+if args.import_file:
+    try:
+        imported, rejected = import_registrations(args.import_file)
+        log.info(f"Imported {imported} registrations from {args.import_file} ({rejected} rejected)\n")
+    except (OSError, ValueError) as e:
+        log.error(f"Error: Could not import {args.import_file}: {e}\n")
+        sys.exit(1)
+
+if args.ttl > 0:
+    client_ttl = args.ttl
+    expiry_last_tick = int(time.monotonic())
+    for client_id in registered_clients:
+        schedule_expiry(client_id)
+
+if args.workers > 0:
+    channels = start_workers(args.workers)
+    if args.metrics_port:
+        metrics_socket = create_server_socket(port=args.metrics_port)
+    log.info(f"Server listening on {server_ip}:{server_port} with {args.workers} workers\n")
+    try:
+        run_coordinator(channels)
+    except KeyboardInterrupt:
+        log.info("Shutting down server.\n")
+    finally:
+        for pid, conn in channels.items():
+            conn.close()
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        sys.exit(0)
+
+server_socket = create_server_socket()
+if args.metrics_port:
+    metrics_socket = create_server_socket(port=args.metrics_port)
+
+log.info(f"Server listening on {server_ip}:{server_port}\n")
 
 try:
-    while True:
-        readable, _, _ = select.select(sockets_list, [], [], 0.2)
-        for notified_socket in readable:
-            if notified_socket == server_socket:
-                client_socket, client_address = server_socket.accept()
-                sockets_list.append(client_socket)
-            elif notified_socket == sys.stdin:
-                command = sys.stdin.readline().strip()
-                handle_server_command(command)
-            else:
-                if not handle_client(notified_socket, notified_socket.getpeername()):
-                    sockets_list.remove(notified_socket)
-                    notified_socket.close()
+    run_engine(server_socket)
 except KeyboardInterrupt:
-    sys.stdout.write("Shutting down server.\n")
+    log.info("Shutting down server.\n")
     sys.exit(0)
 finally:
-    for sock in sockets_list:
-        sock.close()
+    server_socket.close()
     sys.exit(0)
@@ -7,30 +7,163 @@
 from pox.core import core
 import pox.openflow.libopenflow_01 as of
 import pox.lib.packet as pkt
+import ipaddress
+import os
 
 log = core.getLogger()
 
+# Installed flows expire after this long without traffic, and in any case
+# after the hard timeout so policy changes take effect
+IDLE_TIMEOUT = 45
+HARD_TIMEOUT = 600
+
+# Policy file used when launch() isn't given one
+DEFAULT_POLICY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lab5policy.txt")
+IP_PROTOCOLS = {1: "icmp", 6: "tcp", 17: "udp"}
+PROTOCOLS = ("arp", "icmp", "tcp", "udp", "ip", "any")
+ACTIONS = ("accept", "drop")
+# Decisions remembered per (protocol, source, destination) before starting over
+DECISION_CACHE_SIZE = 65536
+
+def packet_protocol (packet, ip_header):
+  """
+  Returns the policy protocol name of a packet, or None if no rule can match it.
+  """
+  if packet.find('arp') is not None:
+    return "arp"
+  if ip_header is None:
+    return None
+  return IP_PROTOCOLS.get(ip_header.protocol, "ip")
+
+class Policy (object):
+  """
+  Firewall rules from a policy file, compiled for constant-time decisions.
+
+  Each line of the file is "<protocol> <source> <destination> <action>",
+  where the addresses are an IP, a CIDR prefix or "any", and the action is
+  accept or drop. A "default <action>" line sets what happens when nothing
+  matches (drop otherwise).
+
+  Rules go into one dict keyed on (protocol, source network, destination
+  network). A packet is looked up once per distinct pair of prefix lengths
+  in the policy, most specific first, and the answer is cached, so the cost
+  doesn't grow with the number of rules. When two rules are equally
+  specific, the one earlier in the file wins.
+  """
+  def __init__ (self, path):
+    self.path = path
+    self.default = "drop"
+    self.table = {}
+    # Groups of equally specific (protocol, source mask, source length,
+    # destination mask, destination length) to try, most specific group first
+    self.levels = []
+    self.cache = {}
+    self.load(path)
+
+  def load (self, path):
+    probes = set()
+    with open(path) as f:
+      for number, line in enumerate(f, 1):
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+          continue
+        if len(fields) == 2 and fields[0] == "default" and fields[1] in ACTIONS:
+          self.default = fields[1]
+          continue
+        if len(fields) != 4 or fields[0] not in PROTOCOLS or fields[3] not in ACTIONS:
+          raise ValueError("%s:%d: expected <protocol> <source> <destination> <action>"
+                           % (path, number))
+        protocol, source, destination, action = fields
+        source, destination = self.network(source), self.network(destination)
+        if protocol == "arp" and (source.prefixlen or destination.prefixlen):
+          # ARP entries match on the ethernet type only
+          raise ValueError("%s:%d: arp rules must use any addresses" % (path, number))
+        key = (protocol, int(source.network_address), source.prefixlen,
+               int(destination.network_address), destination.prefixlen)
+        # A repeated rule keeps the line it first appeared on
+        self.table.setdefault(key, (number, action))
+        probes.add((protocol, source.prefixlen, destination.prefixlen))
+    levels = {}
+    for protocol, source, destination in probes:
+      specificity = (source + destination, protocol != "any")
+      levels.setdefault(specificity, []).append(
+        (protocol, self.mask(source), source, self.mask(destination), destination))
+    self.levels = [levels[specificity] for specificity in sorted(levels, reverse=True)]
+    log.info("Loaded %d firewall rules (%d lookups per new flow at most) from %s"
+             % (len(self.table), len(probes), path))
+
+  @staticmethod
+  def network (text):
+    if text == "any":
+      return ipaddress.ip_network("0.0.0.0/0")
+    return ipaddress.ip_network(text, strict=False)
+
+  @staticmethod
+  def mask (length):
+    return (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+
+  def decide (self, protocol, source, destination):
+    """
+    Returns "accept" or "drop" for a packet; addresses are unsigned ints.
+    """
+    key = (protocol, source, destination)
+    decision = self.cache.get(key)
+    if decision is not None:
+      return decision
+    decision = self.default
+    for level in self.levels:
+      # Every equally specific rule is checked, so the earliest line wins
+      best = None
+      for rule_protocol, source_mask, source_length, destination_mask, destination_length in level:
+        if rule_protocol != protocol and rule_protocol != "any":
+          continue
+        rule = self.table.get((rule_protocol, source & source_mask, source_length,
+                               destination & destination_mask, destination_length))
+        if rule is not None and (best is None or rule[0] < best[0]):
+          best = rule
+      if best is not None:
+        decision = best[1]
+        break
+    if len(self.cache) >= DECISION_CACHE_SIZE:
+      self.cache.clear()
+    self.cache[key] = decision
+    return decision
+
 class Firewall (object):
   """
   A Firewall object is created for each switch that connects.
   A Connection object for that switch is passed to the __init__ function.
   """
-  def __init__ (self, connection):
+  def __init__ (self, connection, policy):
     # Keep track of the connection to the switch so that we can
     # send it messages!
     self.connection = connection
+    self.policy = policy
     # This binds our PacketIn event listener
     connection.addListeners(self)
 
   def do_firewall (self, packet, packet_in):
-    # The code in here will be executed for every packet
-    def accept(out_port = None):
-      # Write code for an accept function
-      msg = of.ofp_packet_out()
+    # The code in here is executed for the first packet of each flow; the
+    # decision is installed on the switch, which handles the packets after it
+    ip_header = packet.find('ipv4')
+
+    def flow_entry():
+      # Match exactly the fields the policy decides on (protocol, source and
+      # destination), so the rest of the conversation never leaves the switch
+      msg = of.ofp_flow_mod()
+      msg.match.dl_type = packet.type
+      if ip_header is not None:
+        msg.match.nw_proto = ip_header.protocol
+        msg.match.nw_src = ip_header.srcip
+        msg.match.nw_dst = ip_header.dstip
+      msg.idle_timeout = IDLE_TIMEOUT
+      msg.hard_timeout = HARD_TIMEOUT
+      # The packet that triggered this is released through the new entry
       msg.data = packet_in
-      msg.idle_timeout = 45
-      msg.hard_timeout = 600
+      return msg
 
+    def accept(out_port = None):
+      msg = flow_entry()
       if out_port is not None:
         msg.actions.append(of.ofp_action_output(port=out_port))
       else:
@@ -39,58 +172,25 @@ class Firewall (object):
       print("Packet Accepted - Flow Table Installed on Switches")
 
     def drop():
-      # Write code for a drop function
-      msg = of.ofp_packet_out()
-      msg.data = packet_in
+      # An entry without actions drops everything it matches
+      msg = flow_entry()
       self.connection.send(msg)
       print("Packet Dropped - Flow Table Installed on Switches")
 
-    # # Write firewall code 
-    if packet.find('arp') is not None:
+    # One table lookup decides the packet
+    protocol = packet_protocol(packet, ip_header)
+    if protocol is None:
+      drop()
+      return
+    if ip_header is None:
+      # Entries for non-IP traffic match on the ethernet type alone
+      source, destination = 0, 0
+    else:
+      source, destination = ip_header.srcip.toUnsigned(), ip_header.dstip.toUnsigned()
+    if self.policy.decide(protocol, source, destination) == "accept":
       accept()
-    elif packet.find('icmp') is not None:
-      ip_header = packet.find('ipv4')
-      if ip_header.dstip != "10.1.1.1":
-        accept()
-      else: drop()
-    elif packet.find('tcp') is not None:
-      ip_header = packet.find('ipv4')
-      if ip_header.srcip == "10.1.1.2":
-        if ip_header.dstip == "10.1.1.1" or ip_header.dstip == "10.1.2.1":
-          accept()
-        else: drop()
-      elif ip_header.srcip == "10.1.1.1":
-        if ip_header.dstip == "10.1.1.2":
-          accept()
-        else: drop()
-      elif ip_header.srcip == "10.1.2.1":
-        if ip_header.dstip == "10.1.1.2":
-          accept()
-        else: drop()
-      else: drop()
-    elif packet.find('udp') is not None:
-      ip_header = packet.find('ipv4')
-      if ip_header.srcip == "10.1.1.2":
-        if ip_header.dstip == "10.1.1.1" or ip_header.dstip == "10.1.2.2":
-          accept()
-        else: drop()
-      else: drop()
-    else: drop()
-
-    # Hints:
-    #
-    # To check the source and destination of an IP packet, you can use
-    # the header information... For example:
-    #
-    # ip_header = packet.find('ipv4')
-    #
-    # if ip_header.srcip == "1.1.1.1":
-    #   print "Packet is from 1.1.1.1"
-    #
-    # Important Note: the "is" comparison DOES NOT work for IP address
-    # comparisons in this way. You must use ==.
-    #
-    # To drop packets, simply omit the action .
+    else:
+      drop()
 
   def _handle_PacketIn (self, event):
     """
@@ -105,11 +205,13 @@ class Firewall (object):
     packet_in = event.ofp # The actual ofp_packet_in message.
     self.do_firewall(packet, packet_in)
 
-def launch ():
+def launch (policy = DEFAULT_POLICY):
   """
-  Starts the components
+  Starts the components; the rules come from the policy file (--policy=<path>)
   """
+  rules = Policy(policy)
+
   def start_switch (event):
     log.debug("Controlling %s" % (event.connection,))
-    Firewall(event.connection)
+    Firewall(event.connection, rules)
   core.openflow.addListenerByName("ConnectionUp", start_switch)
\ No newline at end of file